@@ -0,0 +1,164 @@
+# MaSpeQC - Quality control software for LC-MS/MS instrumentation
+#
+# Copyright (C) 2018-2025  Simon Caven
+# Copyright (C) 2020-2025  Monash University
+# Copyright (C) 2022-2025  University of Applied Sciences Mittweida
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import platform
+import time
+import logging
+logger = logging.getLogger('processing.catalog')
+
+
+def file_signature(path):
+    # (size, mtime) of a raw file, summed over the files of vendor folders (eg. .d), None if missing
+    try:
+        if os.path.isdir(path):
+            size = 0
+            mtime = os.stat(path).st_mtime
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    stat = os.stat(os.path.join(root, name))
+                    size += stat.st_size
+                    mtime = max(mtime, stat.st_mtime)
+            return size, mtime
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+    except OSError:
+        return None
+
+
+class FileCatalog:
+    """
+        Finds the QC files of the machine folders
+        Each folder is read with a single os.scandir pass, the size and mtime come from the scan
+        Vendor folders are only walked (see sign) for the files JobQueue.catalog queues or compares
+        New work is found by comparing the scan with the file names known to the
+        job queue and qc_run (one query per machine), see JobQueue.catalog
+        Used by MPMF_Process_Raw_Files
+    """
+    def __init__(self, in_dir, prefix, file_formats):
+        self.in_dir = in_dir
+        self.prefix = prefix
+        self.file_formats = file_formats
+
+    def scan(self, machine):
+        # returns (file_format, [(path, size, mtime)] newest first)
+        # a machine uses the first format in file_formats that has files
+        # vendor folders (eg. .d) get the size and mtime of the folder itself, see sign
+        found = {}
+        try:
+            with os.scandir(os.path.join(self.in_dir, machine)) as entries:
+                for entry in entries:
+                    if not entry.name.startswith(self.prefix):
+                        continue
+                    for file_format in self.file_formats:
+                        if entry.name.endswith(file_format):
+                            stat = entry.stat()
+                            found.setdefault(file_format, []).append((entry.path, stat.st_size, stat.st_mtime))
+                            break
+        except OSError as e:
+            logger.warning("Unable to read folder for " + machine + ": " + str(e))
+
+        for file_format in self.file_formats:
+            if file_format in found:
+                files = found[file_format]
+                files.sort(key=lambda x: x[2], reverse=True)
+                return file_format, files
+
+        return None, []
+
+    @staticmethod
+    def file_entry(path):
+        # catalog entry for a single file or vendor folder
+        signature = file_signature(path)
+        if signature is None:
+            raise FileNotFoundError(path)
+        return (path,) + signature
+
+    @staticmethod
+    def sign(entry):
+        # entry with the signature used by StabilityGate and JobQueue.hold, summed over the files of
+        # vendor folders, None if the file is gone
+        if not os.path.isdir(entry[0]):
+            return entry
+        signature = file_signature(entry[0])
+        if signature is None:
+            return None
+        return (entry[0],) + signature
+
+    @staticmethod
+    def file_name(entry, file_format):
+        return os.path.basename(entry[0])[:-len(file_format)]
+
+
+class StabilityGate:
+    """
+        Holds back raw files that may still be acquired
+        A file is stable when its size and mtime are unchanged since they were recorded in the catalog,
+        nothing has changed for the quiet period and (where the platform allows) no process has it open
+        Used by JobQueue.claim so external tools are never started on a partial file
+    """
+    def __init__(self, quiet_period, handle_check=True):
+        self.quiet_period = quiet_period
+        self.handle_check = handle_check
+        self.platform = platform.system()
+
+    def check(self, path, size, mtime):
+        # returns (stable, size, mtime) with the current size and mtime
+        signature = file_signature(path)
+        if signature is None:
+            # missing files fail in processing
+            return True, size, mtime
+
+        if signature != (size, mtime):
+            logger.info("Still writing " + path)
+            return False, signature[0], signature[1]
+
+        if time.time() - signature[1] < self.quiet_period:
+            return False, signature[0], signature[1]
+
+        if self.handle_check and self.is_open(path):
+            logger.info("Open in another process " + path)
+            return False, signature[0], signature[1]
+
+        return True, signature[0], signature[1]
+
+    def is_open(self, path):
+        if self.platform == 'Windows':
+            # fails while the acquisition software holds the file
+            try:
+                os.rename(path, path)
+                return False
+            except OSError:
+                return True
+        elif self.platform == 'Linux':
+            # open file descriptors of local processes
+            real_path = os.path.realpath(path)
+            try:
+                pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
+            except OSError:
+                return False
+            for pid in pids:
+                try:
+                    for fd in os.listdir(os.path.join('/proc', pid, 'fd')):
+                        target = os.readlink(os.path.join('/proc', pid, 'fd', fd))
+                        if target == real_path or target.startswith(real_path + os.sep):
+                            return True
+                except OSError:
+                    continue
+        return False
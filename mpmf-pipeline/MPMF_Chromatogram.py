@@ -27,6 +27,7 @@ import sys
 import xml.etree.ElementTree as et # descriptions of the scans are stored as xml
 import zipfile # mzmine files are zip files
 import logging
+from MPMF_Metrics import registry
 logger = logging.getLogger('processing.chromatograms')
 
 
@@ -46,6 +47,8 @@ class Chromatogram:
         self.peaklistfiles = []
         self.scansfiles = []
         self.rawdatafiles = []
+        self.inserted = 0
+        self.rows = []  # chromatograms inserted together when every peak list is read
 
         if not os.path.isfile(self.path):
             logger,error("file " + self.path + " does not exist")
@@ -53,13 +56,21 @@ class Chromatogram:
 
         self.unzip_files()
         self.create_xic()
+        self.insert_rows()
         logger.info("INSERTED CHROMATOGRAMS for " + self.file_name)
+        registry.inc("maspeqc_chromatograms_inserted_total", {"machine": self.machine}, self.inserted)
 
     def unzip_files(self):
         with zipfile.ZipFile(self.path, "r") as _zip:
             # get all files in mzmine file
             namelist = _zip.namelist()
 
+            # projects saved before batches were split per run (see split_mzmine_project) hold the raw data
+            # and peak lists of every run, entries are named after the mzML files eg. "Raw data file #1 <file>_pos.mzML"
+            own = [filename for filename in namelist if " " + self.file_name + "_" in filename]
+            if own:
+                namelist = own
+
             # find files
             for filename in namelist:
                 if filename.startswith("Peak list #") and filename.endswith(".xml"):
@@ -148,11 +159,13 @@ class Chromatogram:
 
             scansfile = None
             rawdatafile = None
+            # "#1" must not match "#10" in projects with many raw files
+            prefix = "Raw data file #" + peaksdict["rawfile"]
             for filename in self.scansfiles:
-                if filename.startswith("Raw data file #" + peaksdict["rawfile"]):
+                if filename.startswith(prefix) and not filename[len(prefix):len(prefix) + 1].isdigit():
                     scansfile = filename
             for filename in self.rawdatafiles:
-                if filename.startswith("Raw data file #" + peaksdict["rawfile"]):
+                if filename.startswith(prefix) and not filename[len(prefix):len(prefix) + 1].isdigit():
                     rawdatafile = filename
 
             # store scans as dictionary
@@ -327,16 +340,18 @@ class Chromatogram:
     def insert_chromatogram_data(self, c_id, chrom_dict):
 
         json_data = json.dumps(chrom_dict, separators=(",", ":"))
+        self.rows.append((json_data, self.run_id, c_id))
 
-        sql = "INSERT INTO chromatogram VALUES(NULL,'" + json_data + "','" + str(self.run_id) + \
-                    "','" + str(c_id) + "')"
-
+    def insert_rows(self):
+        # one multi-row insert (or LOAD DATA on bulk connections) and a single commit for the run
         try:
-            self.db.cursor.execute(sql)
+            self.db.insert_rows("chromatogram", self.rows)
+            self.db.db.commit()
+            self.inserted = len(self.rows)
         except Exception as e:
             logger.exception(e)
-
-        self.db.db.commit()
+            self.db.db.rollback()
+        self.rows = []
 
     def get_rt_indexes(self, start, rts):
         min_index = 0
@@ -0,0 +1,145 @@
+# MaSpeQC - Quality control software for LC-MS/MS instrumentation
+#
+# Copyright (C) 2018-2025  Simon Caven
+# Copyright (C) 2020-2025  Monash University
+# Copyright (C) 2022-2025  University of Applied Sciences Mittweida
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+import types
+import logging
+logger = logging.getLogger('processing.config')
+
+
+class ConfigCache:
+    """
+        The pipe delimited configuration files (thresholds, reference databases, pump limits)
+        parsed once per process and shared by every module
+        The parsed values are read only (tuples and mappingproxy) as they are shared
+        In watch and node mode refresh is called every round, files that changed are read again
+        Used by ProcessRawFile, FileSystem, Stat and ThermoMetrics
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}  # (path, parser) -> (signature, value)
+        self.found = {}  # (path, default) -> path used
+
+    def get(self, path, parser):
+        # parsed contents of the file
+        key = (path, parser)
+        with self.lock:
+            entry = self.files.get(key)
+        if entry is not None:
+            return entry[1]
+
+        # signature first, a change while reading is picked up by the next refresh
+        signature = stat_signature(path)
+        with open(path, "r") as f:
+            value = parser(f)
+        with self.lock:
+            self.files[key] = (signature, value)
+        return value
+
+    def find(self, path, default):
+        # path if it exists, otherwise default (machine specific configuration files)
+        key = (path, default)
+        with self.lock:
+            if key in self.found:
+                return self.found[key]
+        found = path if os.path.exists(path) else default
+        with self.lock:
+            self.found[key] = found
+        return found
+
+    def refresh(self):
+        # forgets the files that changed since they were read, returns True if any did
+        with self.lock:
+            files = list(self.files.items())
+            found = list(self.found.items())
+
+        changed = [key for key, entry in files if stat_signature(key[0]) != entry[0]]
+        moved = [key for key, path in found if (key[0] if os.path.exists(key[0]) else key[1]) != path]
+
+        with self.lock:
+            for key in changed:
+                self.files.pop(key, None)
+            for key in moved:
+                self.found.pop(key, None)
+
+        for path in sorted(set([key[0] for key in changed] + [key[0] for key in moved])):
+            logger.info("Configuration changed: " + path)
+        return len(changed) + len(moved) > 0
+
+    def clear(self):
+        with self.lock:
+            self.files = {}
+            self.found = {}
+
+
+def stat_signature(path):
+    # (mtime, size), None if missing
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+
+def parse_thresholds(f):
+    # metric -> (number of components, lower, upper) from a thresholds file
+    lines = f.readlines()
+    lines.pop(0)  # header
+    thresholds = {}
+    for line in lines:
+        limit = line.split("|")
+        if limit[1] != '':
+            thresholds[limit[0]] = (limit[1], limit[2], limit[3].strip())
+    return types.MappingProxyType(thresholds)
+
+
+def parse_reference_db(f):
+    # component -> expected retention time from a reference database (iRT, positive, negative)
+    lines = f.readlines()
+    lines.pop(0)  # header
+    samples = {}
+    for line in lines:
+        sample = line.split("|")
+        samples[sample[2].strip()] = float(sample[1])
+    return types.MappingProxyType(samples)
+
+
+def parse_pump_limits(f):
+    # valve limits from the last line of a loading pump file
+    pump_limits = ()
+    for line in f:
+        pump_limits = tuple(line.strip().split("|"))
+    return pump_limits
+
+
+# configuration of this process
+config = ConfigCache()
+
+
+def read_thresholds(path):
+    return config.get(path, parse_thresholds)
+
+
+def read_reference_db(path):
+    return config.get(path, parse_reference_db)
+
+
+def read_pump_limits(path):
+    return config.get(path, parse_pump_limits)
@@ -17,34 +17,45 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import contextlib
 import json
 import logging
 import os
 import sys
+import tempfile
+import threading
+import time
 
 from MPMF_File_System import FileSystem
 
 # LOGGING
-# create module logger 
+# create module logger, handlers are added by init_logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-# create file handler which logs even debug messages
-fh = logging.FileHandler('database.log')
-fh.setLevel(logging.DEBUG)
 
-# create console handler with a higher log level
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
+def init_logging():
+    # logs to database.log and the console, called by the scripts instead of on import
+    if logger.handlers:
+        return
 
-# create formatter and add it to the handlers
-formatter = logging.Formatter('%(levelname)s - %(name)s - %(asctime)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
-fh.setFormatter(formatter)
-ch.setFormatter(formatter)
+    # create file handler which logs even debug messages, the file is opened with the first record
+    fh = logging.FileHandler('database.log', delay=True)
+    fh.setLevel(logging.DEBUG)
+
+    # create console handler with a higher log level
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter('%(levelname)s - %(name)s - %(asctime)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+    fh.setFormatter(formatter)
+    ch.setFormatter(formatter)
+
+    # add the handlers to the logger
+    logger.addHandler(fh)
+    logger.addHandler(ch)
 
-# add the handlers to the logger
-logger.addHandler(fh)
-logger.addHandler(ch)
 
 try:
     import pymysql as MySQLdb
@@ -54,6 +65,24 @@ except ImportError as e:
     sys.exit(1)
 
 
+# tables written with insert_rows, table -> columns (the auto increment ids are left to MySQL)
+BULK_COLUMNS = {
+    "measurement": ["metric_id", "component_id", "run_id", "value"],
+    "chromatogram": ["chrom_data", "run_id", "component_id"],
+    "pressure_profile": ["pressure_data", "pump_type", "run_id"],
+}
+
+# errors of LOAD DATA LOCAL INFILE when local_infile is off on the server
+LOCAL_INFILE_DISABLED = (1148, 2068, 3948)
+
+# foreign keys checked after a bulk load, table -> [(column, parent table)]
+BULK_REFERENCES = {
+    "measurement": [("metric_id", "metric"), ("component_id", "sample_component"), ("run_id", "qc_run")],
+    "chromatogram": [("component_id", "sample_component"), ("run_id", "qc_run")],
+    "pressure_profile": [("run_id", "qc_run")],
+}
+
+
 class MPMFDBSetUp:
     """
         Database access module
@@ -63,15 +92,21 @@ class MPMFDBSetUp:
     """
 
     # CONSTRUCTOR connects to database as user with pword
-    def __init__(self, user, pword, database, filesystem, portnumber):
+    # host is the MySQL server shared by the processing nodes, localhost by default
+    # bulk connections load rows with LOAD DATA LOCAL INFILE (see insert_rows)
+    def __init__(self, user, pword, database, filesystem, portnumber, host="localhost", bulk=False):
         self.username = user
         self.password = pword
         self.database = database
         self.fs = filesystem
         self.port = portnumber
+        self.host = host
         self.connected = False
+        self.ids = IdRegistry(self)
+        self.bulk = bulk
         try:
-            self.db = MySQLdb.connect(host="localhost", user=self.username, password=self.password, db=self.database, port=self.port)
+            self.db = MySQLdb.connect(host=self.host, user=self.username, password=self.password, db=self.database, port=self.port,
+                                      local_infile=self.bulk)
             self.cursor = self.db.cursor()
             self.connected = True
             logger.info("Database Connection Made")
@@ -79,6 +114,22 @@ class MPMFDBSetUp:
             logger.exception(e)
             sys.exit(1)
 
+    def check(self):
+        # reconnects if the server has closed the connection, False if the database can't be reached
+        try:
+            self.db.ping(reconnect=True)
+            return True
+        except Exception as e:
+            logger.warning("Database connection lost: " + str(e))
+            return False
+
+    def close(self):
+        try:
+            self.cursor.close()
+            self.db.close()
+        except Exception:
+            pass
+
     def set_up(self):
         self.drop_all_tables()
         self.create_all_tables()
@@ -98,6 +149,10 @@ class MPMFDBSetUp:
         self.create_table_stat()
         self.create_table_chromatogram()
         self.create_table_pressure_profile()
+        self.create_table_processing_job()
+        self.create_table_machine_lock()
+        self.create_table_stage_timing()
+        self.create_table_stats_pending()
 
     def create_table_sample_component(self):
         sql = "CREATE TABLE IF NOT EXISTS sample_component (" \
@@ -268,6 +323,92 @@ class MPMFDBSetUp:
         except Exception as e:
             logger.exception(e)
 
+    def create_table_processing_job(self):
+        # queue of raw files to process, state is queued, running, done or failed
+        sql = "CREATE TABLE IF NOT EXISTS processing_job (" \
+              "job_id INT AUTO_INCREMENT NOT NULL," \
+              "file_name VARCHAR(255) NOT NULL," \
+              "file_path TEXT NOT NULL," \
+              "file_format VARCHAR(10) NOT NULL," \
+              "file_size BIGINT," \
+              "file_mtime DOUBLE," \
+              "machine_id INT NOT NULL," \
+              "experiment_id INT NOT NULL," \
+              "state VARCHAR(10) NOT NULL," \
+              "priority TINYINT NOT NULL DEFAULT 0," \
+              "attempts INT NOT NULL DEFAULT 0," \
+              "next_attempt DATETIME," \
+              "lease_owner VARCHAR(255)," \
+              "lease_expires DATETIME," \
+              "heartbeat DATETIME," \
+              "last_error TEXT," \
+              "created DATETIME NOT NULL," \
+              "updated DATETIME NOT NULL," \
+              "PRIMARY KEY(job_id)," \
+              "UNIQUE KEY(file_name)," \
+              "KEY(machine_id, experiment_id, state)," \
+              "FOREIGN KEY (machine_id) REFERENCES machine(machine_id)," \
+              "FOREIGN KEY (experiment_id) REFERENCES experiment(experiment_id))"
+
+        try:
+            self.cursor.execute(sql)
+        except Exception as e:
+            logger.exception(e)
+
+    def create_table_machine_lock(self):
+        # one processing owner per machine and experiment, expires unless renewed
+        sql = "CREATE TABLE IF NOT EXISTS machine_lock (" \
+              "machine_id INT NOT NULL," \
+              "experiment_id INT NOT NULL," \
+              "lease_owner VARCHAR(255) NOT NULL," \
+              "lease_expires DATETIME NOT NULL," \
+              "PRIMARY KEY(machine_id, experiment_id)," \
+              "FOREIGN KEY (machine_id) REFERENCES machine(machine_id)," \
+              "FOREIGN KEY (experiment_id) REFERENCES experiment(experiment_id))"
+
+        try:
+            self.cursor.execute(sql)
+        except Exception as e:
+            logger.exception(e)
+
+    def create_table_stats_pending(self):
+        # machines with runs inserted by processing nodes, the stats are updated by the holder of the machine lock
+        sql = "CREATE TABLE IF NOT EXISTS stats_pending (" \
+              "machine_id INT NOT NULL," \
+              "experiment_id INT NOT NULL," \
+              "since DATETIME NOT NULL," \
+              "PRIMARY KEY(machine_id, experiment_id)," \
+              "FOREIGN KEY (machine_id) REFERENCES machine(machine_id)," \
+              "FOREIGN KEY (experiment_id) REFERENCES experiment(experiment_id))"
+
+        try:
+            self.cursor.execute(sql)
+        except Exception as e:
+            logger.exception(e)
+
+    def create_table_stage_timing(self):
+        # processing time and resources per stage of a run
+        sql = "CREATE TABLE IF NOT EXISTS stage_timing (" \
+              "run_id INT NOT NULL," \
+              "stage VARCHAR(20) NOT NULL," \
+              "wall_time DOUBLE NOT NULL," \
+              "cpu_time DOUBLE," \
+              "peak_rss BIGINT," \
+              "read_bytes BIGINT," \
+              "write_bytes BIGINT," \
+              "processed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP," \
+              "PRIMARY KEY(run_id, stage)," \
+              "FOREIGN KEY (run_id) REFERENCES qc_run(run_id) ON DELETE CASCADE)"
+
+        try:
+            self.cursor.execute(sql)
+            # tables created before the time of processing was recorded
+            self.cursor.execute("SHOW COLUMNS FROM stage_timing LIKE 'processed_at'")
+            if not self.cursor.fetchall():
+                self.cursor.execute("ALTER TABLE stage_timing "
+                                    "ADD COLUMN processed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP")
+        except Exception as e:
+            logger.exception(e)
 
     # DROP TABLES
     def drop_table(self, tablename):
@@ -281,7 +422,7 @@ class MPMFDBSetUp:
 
     def drop_all_tables(self):
         # order by constraints
-        tables = ['measurement', 'stat', 'pressure_profile', 'chromatogram', 'qc_run',
+        tables = ['processing_job', 'machine_lock', 'stats_pending', 'stage_timing', 'measurement', 'stat', 'pressure_profile', 'chromatogram', 'qc_run',
                   'sample_component', 'metric', 'digest', 'machine', 'experiment']
         for table in tables:
             self.drop_table(table)
@@ -295,6 +436,7 @@ class MPMFDBSetUp:
         self.insert_machines()
         self.insert_digests()
         self.insert_components()
+        self.ids.clear()
 
     def insert_digests(self):
 
@@ -550,6 +692,51 @@ class MPMFDBSetUp:
         except Exception as e:
             logger.exception(e)
 
+    # BULK INSERTS
+    def insert_rows(self, table, rows):
+        # inserts rows (values of BULK_COLUMNS[table]), the caller commits
+        # bulk connections load them with LOAD DATA, others with multi-row INSERTs
+        if len(rows) == 0:
+            return
+        if self.bulk:
+            try:
+                self.load_rows(table, rows)
+                return
+            except MySQLdb.MySQLError as e:
+                if e.args[0] not in LOCAL_INFILE_DISABLED:
+                    raise
+                logger.warning("Unable to bulk load " + table + ", inserting rows instead: " + str(e))
+                self.bulk = False
+        columns = BULK_COLUMNS[table]
+        sql = "INSERT INTO " + table + " (" + ", ".join(columns) + ") VALUES (" + ", ".join(["%s"] * len(columns)) + ")"
+        self.cursor.executemany(sql, rows)
+
+    def load_rows(self, table, rows):
+        # stages the rows in a temporary tab separated file and loads it with the
+        # foreign key and unique checks off, rows without a parent are deleted afterwards
+        with tempfile.NamedTemporaryFile("w", suffix=".tsv", encoding="utf-8", newline="\n", delete=False) as f:
+            for row in rows:
+                f.write("\t".join([tsv_value(value) for value in row]) + "\n")
+        try:
+            self.cursor.execute("SET SESSION foreign_key_checks = 0, unique_checks = 0")
+            try:
+                # LOCAL skips rows with duplicate keys
+                self.cursor.execute("LOAD DATA LOCAL INFILE %s INTO TABLE " + table + " CHARACTER SET utf8mb4 "
+                                    "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+                                    "(" + ", ".join(BULK_COLUMNS[table]) + ")", (f.name,))
+            finally:
+                self.cursor.execute("SET SESSION foreign_key_checks = 1, unique_checks = 1")
+        finally:
+            os.remove(f.name)
+
+        run_ids = sorted(set([row[BULK_COLUMNS[table].index("run_id")] for row in rows]))
+        for column, parent in BULK_REFERENCES[table]:
+            deleted = self.cursor.execute("DELETE c FROM " + table + " c LEFT JOIN " + parent + " p ON p." + column
+                                          + " = c." + column + " WHERE p." + column + " IS NULL AND c.run_id IN ("
+                                          + ", ".join(["%s"] * len(run_ids)) + ")", run_ids)
+            if deleted:
+                logger.warning("Deleted " + str(deleted) + " " + table + " rows with an unknown " + column)
+
     # GETS
     def get_run_id(self, datafile):
         sql = "SELECT run_id FROM qc_run WHERE file_name = " + "'" + datafile + "'"
@@ -561,25 +748,18 @@ class MPMFDBSetUp:
             logger.exception(e)
             return False
 
+    # ids of the lookup tables from the registry of the connection, None if the name isn't found
     def get_metric_id(self, name):
-        sql = "SELECT metric_id FROM metric WHERE metric_name = " + "'" + name + "'"
-        try:
-            self.cursor.execute(sql)
-            metric_id = self.cursor.fetchone()
-            return metric_id[0]
-        except Exception as e:
-            logger.exception(e)
-            return False
+        return self.ids.get("metric", name)
 
     def get_component_id(self, name):
-        sql = "SELECT component_id FROM sample_component WHERE component_name = " + "'" + name + "'"
-        try:
-            self.cursor.execute(sql)
-            comp_id = self.cursor.fetchone()
-            return comp_id[0]
-        except Exception as e:
-            logger.exception(e)
-            return False
+        return self.ids.get("sample_component", name)
+
+    def get_machine_id(self, name):
+        return self.ids.get("machine", name)
+
+    def get_experiment_id(self, experiment_type):
+        return self.ids.get("experiment", experiment_type)
 
     def get_measurement(self, cid, mid, rid):
         sql = "SELECT m.metric_name, c.component_name, r.value, q.date_time FROM " \
@@ -643,8 +823,155 @@ class MPMFDBSetUp:
                     logger.exception(e)
             self.db.commit()
 
+
+def tsv_value(value):
+    # a value for LOAD DATA, NULL as \N and the escape, tab and newline characters escaped
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class IdRegistry:
+    """
+        Name to id maps of the lookup tables (metric, sample_component, machine, experiment)
+        Loaded with one query per table when the first id is needed and kept with the connection
+        A name that isn't found loads the tables again, at most every RELOAD_AFTER seconds,
+        so machines, components and metrics added by the set up script are picked up
+        Used by MPMFDBSetUp
+    """
+    # table -> query for (name, id)
+    TABLES = {
+        "metric": "SELECT metric_name, metric_id FROM metric",
+        "sample_component": "SELECT component_name, component_id FROM sample_component",
+        "machine": "SELECT machine_name, machine_id FROM machine",
+        "experiment": "SELECT experiment_type, experiment_id FROM experiment",
+    }
+    RELOAD_AFTER = 60
+
+    def __init__(self, db):
+        self.db = db
+        self.ids = None  # table -> {name: id}
+        self.loaded = 0
+
+    @staticmethod
+    def key(name):
+        # names are compared like MySQL does, case insensitive and without trailing spaces
+        return str(name).rstrip().lower()
+
+    def load(self):
+        ids = {}
+        for table in self.TABLES:
+            self.db.cursor.execute(self.TABLES[table])
+            ids[table] = {self.key(row[0]): row[1] for row in self.db.cursor.fetchall()}
+        self.ids = ids
+        self.loaded = time.time()
+
+    def get(self, table, name):
+        try:
+            if self.ids is None:
+                self.load()
+            key = self.key(name)
+            if key not in self.ids[table] and time.time() - self.loaded > self.RELOAD_AFTER:
+                self.load()
+            return self.ids[table].get(key)
+        except Exception as e:
+            logger.exception(e)
+            return None
+
+    def clear(self):
+        # loads the tables again when the next id is needed
+        self.ids = None
+
+
+class MPMFDBPool:
+    """
+        Connections shared by the threads of a process
+        A worker checks out a connection, uses it on its own and checks it in when done
+        Connections idle for longer than check_after seconds are checked (and reconnected) before reuse
+        Used through get_pool by the pipeline modules
+    """
+    def __init__(self, user, pword, database, portnumber, size=4, check_after=30, host="localhost", bulk=False):
+        self.username = user
+        self.password = pword
+        self.database = database
+        self.port = portnumber
+        self.host = host
+        self.bulk = bulk
+        self.size = size  # idle connections kept
+        self.check_after = check_after
+        self.pid = os.getpid()
+        self.idle = []  # [(MPMFDBSetUp, time checked in)]
+        self.lock = threading.Lock()
+
+    def checkout(self, filesystem=""):
+        # returns a working connection, a new one if none are idle
+        while True:
+            with self.lock:
+                entry = self.idle.pop() if self.idle else None
+            if entry is None:
+                db = MPMFDBSetUp(self.username, self.password, self.database, filesystem, self.port, self.host, self.bulk)
+                break
+            db, checked_in = entry
+            if time.monotonic() - checked_in < self.check_after or db.check():
+                break
+            db.close()
+        db.fs = filesystem
+        return db
+
+    def checkin(self, db):
+        # ends any open transaction so the next user doesn't see an old snapshot
+        try:
+            db.db.rollback()
+        except Exception:
+            db.close()
+            return
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((db, time.monotonic()))
+                return
+        db.close()
+
+    @contextlib.contextmanager
+    def connection(self, filesystem=""):
+        db = self.checkout(filesystem)
+        try:
+            yield db
+        finally:
+            self.checkin(db)
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for db, _ in idle:
+            db.close()
+
+
+# pool of this process for each database
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(db_info, size=None):
+    # returns the pool for the db_info (user, password, database, port, optional host and bulk) of the pipeline
+    host = db_info.get("host", "localhost")
+    bulk = db_info.get("bulk", False)
+    key = (host, db_info["user"], db_info["database"], db_info["port"], bulk)
+    with pools_lock:
+        pool = pools.get(key)
+        if pool is None or pool.pid != os.getpid():
+            # connections inherited from a parent process are left alone, closing them would close the parent's
+            pool = MPMFDBPool(db_info["user"], db_info["password"], db_info["database"], db_info["port"], host=host, bulk=bulk)
+            pools[key] = pool
+        if size is not None:
+            pool.size = size
+        return pool
+
+
 if __name__ == "__main__":
 
+    init_logging()
+
     # read in db details
     try:
         with open(os.path.join(os.getcwd(), "Config", "database-login.json"), 'r') as f:
@@ -657,6 +984,7 @@ if __name__ == "__main__":
     user = db_details["User"]
     port = db_details["Database Port"]
     database_name = db_details["Database Name"]
+    host = db_details.get("Database Host", "localhost")
 
     try:
         with open(os.path.join(os.getcwd(), "Config", ".maspeqc_gen"), "r") as f:
@@ -670,7 +998,7 @@ if __name__ == "__main__":
     fs = FileSystem("", "", "", "")
 
     # connect to db
-    db = MPMFDBSetUp(user, password, database_name, fs, port)
+    db = MPMFDBSetUp(user, password, database_name, fs, port, host)
 
     if db.connected:
         # add tables and data
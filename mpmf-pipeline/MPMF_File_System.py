@@ -18,6 +18,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+from MPMF_Config import config
 
 
 class FileSystem:
@@ -41,33 +42,46 @@ class FileSystem:
             self.xml_template_proteo = os.path.join(self.config_dir, "proteo_template.xml")
             self.out_dir = out_directory
 
+            # (machine file, default file), the file used is looked up in the config cache
+            # so a machine file added while watching is picked up
             # set Proteomics mzmine input file
             if experiment.upper() == "PROTEOMICS":
                 instr_file = "iRT-Reference-" + machine + ".csv"
-                self.irt_db = os.path.join(self.databases, instr_file)
-                if not os.path.exists(self.irt_db):
-                    self.irt_db = os.path.join(self.databases, "iRT-Reference-Default.csv")
+                self.irt_db_files = (os.path.join(self.databases, instr_file),
+                                     os.path.join(self.databases, "iRT-Reference-Default.csv"))
 
                 # and threshold file for email notification
                 threshold_file = "proteomics-thresholds-" + machine + ".txt"
-                self.thresh_email = os.path.join(self.thresholds, threshold_file)
-                if not os.path.exists(self.thresh_email):
-                    self.thresh_email = os.path.join(self.thresholds, "proteomics-thresholds-default.txt")
+                self.thresh_email_files = (os.path.join(self.thresholds, threshold_file),
+                                           os.path.join(self.thresholds, "proteomics-thresholds-default.txt"))
 
             # set Metabolomics mzmine input file
             if experiment.upper() == "METABOLOMICS":
                 instr_file_neg = "negative-db-" + machine + ".csv"
                 instr_file_pos = "positive-db-" + machine + ".csv"
-                self.neg_db = os.path.join(self.databases, instr_file_neg)
-                self.pos_db = os.path.join(self.databases, instr_file_pos)
-                if not os.path.exists(self.neg_db):
-                    self.neg_db = os.path.join(self.databases, "negative-db-Default.csv")
-                if not os.path.exists(self.pos_db):
-                    self.pos_db = os.path.join(self.databases, "positive-db-Default.csv")
+                self.neg_db_files = (os.path.join(self.databases, instr_file_neg),
+                                     os.path.join(self.databases, "negative-db-Default.csv"))
+                self.pos_db_files = (os.path.join(self.databases, instr_file_pos),
+                                     os.path.join(self.databases, "positive-db-Default.csv"))
 
                 # and threshold file for email notification
                 threshold_file = "metab-thresholds-" + machine + ".txt"
-                self.thresh_email = os.path.join(self.thresholds, threshold_file)
-                if not os.path.exists(self.thresh_email):
-                    self.thresh_email = os.path.join(self.thresholds, "metab-thresholds-default.txt")
+                self.thresh_email_files = (os.path.join(self.thresholds, threshold_file),
+                                           os.path.join(self.thresholds, "metab-thresholds-default.txt"))
+
+    @property
+    def irt_db(self):
+        return config.find(*self.irt_db_files)
+
+    @property
+    def neg_db(self):
+        return config.find(*self.neg_db_files)
+
+    @property
+    def pos_db(self):
+        return config.find(*self.pos_db_files)
+
+    @property
+    def thresh_email(self):
+        return config.find(*self.thresh_email_files)
 
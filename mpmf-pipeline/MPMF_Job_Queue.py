@@ -0,0 +1,367 @@
+# MaSpeQC - Quality control software for LC-MS/MS instrumentation
+#
+# Copyright (C) 2018-2025  Simon Caven
+# Copyright (C) 2020-2025  Monash University
+# Copyright (C) 2022-2025  University of Applied Sciences Mittweida
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import socket
+import threading
+import logging
+from MPMF_Catalog import FileCatalog, StabilityGate
+from MPMF_Database_SetUp import get_pool
+logger = logging.getLogger('processing.jobs')
+
+
+class JobQueue:
+    """
+        Database queue of raw files (processing_job table)
+        and per machine locks (machine_lock table)
+        Jobs and locks are leases that are renewed by a Heartbeat,
+        so the work of a crashed process is picked up again once its lease expires
+        Failed jobs are retried with an increasing delay up to a maximum number of attempts
+        Jobs have a priority (0 for live processing, 1 for backfills) and a queue only claims its own priority
+        With in_dir (processing nodes), claimed files are found in the node's own input folder
+        Used by MPMF_Process_Raw_Files
+    """
+    def __init__(self, db, experiment_type, settings, priority=0, in_dir=None):
+        self.db = db
+        self.experiment = experiment_type.lower()
+        self.owner = socket.gethostname() + ":" + str(os.getpid())
+        self.lease = int(settings["Job Lease"])
+        self.retry_delay = int(settings["Job Retry Delay"])
+        self.max_attempts = int(settings["Job Max Attempts"])
+        self.lock = threading.Lock()  # db connection is shared by the pipeline stage threads
+        self.priority = priority
+        self.in_dir = in_dir
+        self.gate = None
+        if settings["Stability Quiet Period"] > 0:
+            self.gate = StabilityGate(settings["Stability Quiet Period"], settings["Stability Handle Check"])
+
+        self.experiment_id = self.db.get_experiment_id(self.experiment)
+
+    def get_machine_id(self, machine):
+        return self.db.get_machine_id(machine)
+
+    # LOCKS
+    def acquire_machine_lock(self, machine):
+        # True if this process now holds the lock for the machine
+        with self.lock:
+            machine_id = self.get_machine_id(machine)
+            try:
+                self.db.cursor.execute("INSERT IGNORE INTO machine_lock VALUES (%s, %s, %s, NOW() - INTERVAL 1 SECOND)",
+                                       (machine_id, self.experiment_id, self.owner))
+                self.db.cursor.execute("UPDATE machine_lock SET lease_owner = %s, lease_expires = NOW() + INTERVAL %s SECOND "
+                                       "WHERE machine_id = %s AND experiment_id = %s "
+                                       "AND (lease_owner = %s OR lease_expires < NOW())",
+                                       (self.owner, self.lease, machine_id, self.experiment_id, self.owner))
+                self.db.cursor.execute("SELECT lease_owner FROM machine_lock WHERE machine_id = %s AND experiment_id = %s",
+                                       (machine_id, self.experiment_id))
+                holder = self.db.cursor.fetchone()[0]
+                self.db.db.commit()
+            except Exception as e:
+                self.db.db.rollback()
+                logger.exception(e)
+                return False
+
+        return holder == self.owner
+
+    def release_machine_lock(self, machine):
+        with self.lock:
+            try:
+                self.db.cursor.execute("DELETE FROM machine_lock WHERE machine_id = %s AND experiment_id = %s AND lease_owner = %s",
+                                       (self.get_machine_id(machine), self.experiment_id, self.owner))
+                self.db.db.commit()
+            except Exception as e:
+                logger.exception(e)
+
+    # JOBS
+    def known_files(self, machine):
+        # file name -> (state, size, mtime, priority, job_id) for every file of the machine in the queue or in qc_run
+        machine_id = self.get_machine_id(machine)
+        known = {}
+        with self.lock:
+            self.db.cursor.execute("SELECT file_name, state, file_size, file_mtime, priority, job_id FROM processing_job "
+                                   "WHERE machine_id = %s AND experiment_id = %s", (machine_id, self.experiment_id))
+            for row in self.db.cursor.fetchall():
+                known[row[0]] = (row[1], row[2], row[3], row[4], row[5])
+            self.db.cursor.execute("SELECT file_name FROM qc_run WHERE machine_id = %s AND experiment_id = %s",
+                                   (machine_id, self.experiment_id))
+            for row in self.db.cursor.fetchall():
+                if row[0] not in known:
+                    known[row[0]] = ("processed", None, None, None, None)
+            self.db.db.commit()
+        return known
+
+    def catalog(self, machine, files, file_format, window):
+        # compares a scan of the machine folder, [(path, size, mtime)] newest first, with the known files
+        # new files among the most recent (window) are queued
+        # files processed before the queue existed are added as done so later scans only need the queue
+        # failed files that changed on disk since they were added are queued again
+        known = self.known_files(machine)
+        new_files = []
+        processed = []
+        changed = []
+        promoted = []
+        for i in range(len(files)):
+            file_name = FileCatalog.file_name(files[i], file_format)
+            if file_name not in known:
+                if i < window:
+                    entry = FileCatalog.sign(files[i])
+                    if entry is not None:
+                        new_files.append(entry)
+                continue
+            if i < window and self.priority == 0 and known[file_name][0] == "queued" and known[file_name][3] > self.priority:
+                # backfill files that are now among the most recent are live again
+                promoted.append(known[file_name][4])
+            if known[file_name][0] == "processed":
+                processed.append(files[i])
+            elif known[file_name][0] == "failed":
+                entry = FileCatalog.sign(files[i])
+                if entry is not None and (known[file_name][1], known[file_name][2]) != (entry[1], entry[2]):
+                    changed.append(entry)
+
+        self.enqueue(machine, new_files, file_format)
+        self.enqueue(machine, processed, file_format, "done")
+        self.requeue(machine, changed, file_format)
+        self.promote(promoted)
+        logger.info(machine + ": " + str(len(new_files)) + " new, " + str(len(changed)) + " changed files")
+        return len(new_files) + len(changed)
+
+    def enqueue(self, machine, files, file_format, state="queued"):
+        # adds [(path, size, mtime)], files already in the queue are ignored
+        rows = []
+        for entry in files:
+            rows.append((FileCatalog.file_name(entry, file_format), entry[0], file_format, entry[1], entry[2],
+                         self.get_machine_id(machine), self.experiment_id, state, self.priority))
+        if len(rows) == 0:
+            return
+
+        with self.lock:
+            try:
+                self.db.cursor.executemany("INSERT IGNORE INTO processing_job (file_name, file_path, file_format, file_size, "
+                                           "file_mtime, machine_id, experiment_id, state, priority, attempts, created, updated) "
+                                           "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 0, NOW(), NOW())", rows)
+                self.db.db.commit()
+            except Exception as e:
+                self.db.db.rollback()
+                logger.exception(e)
+
+    def requeue(self, machine, files, file_format):
+        # queues [(path, size, mtime)] again with new attempts
+        rows = []
+        for entry in files:
+            rows.append((entry[1], entry[2], FileCatalog.file_name(entry, file_format), self.get_machine_id(machine)))
+        if len(rows) == 0:
+            return
+
+        with self.lock:
+            try:
+                self.db.cursor.executemany("UPDATE processing_job SET state = 'queued', attempts = 0, file_size = %s, "
+                                           "file_mtime = %s, updated = NOW() WHERE file_name = %s AND machine_id = %s", rows)
+                self.db.db.commit()
+            except Exception as e:
+                self.db.db.rollback()
+                logger.exception(e)
+
+    def promote(self, job_ids):
+        # moves queued jobs to the priority of this queue with one statement
+        if len(job_ids) == 0:
+            return
+
+        with self.lock:
+            try:
+                self.db.cursor.execute("UPDATE processing_job SET priority = %s WHERE job_id IN ("
+                                       + ", ".join(["%s"] * len(job_ids)) + ") AND state = 'queued' AND priority > %s",
+                                       [self.priority] + job_ids + [self.priority])
+                self.db.db.commit()
+            except Exception as e:
+                self.db.db.rollback()
+                logger.exception(e)
+
+    def claim(self, machine):
+        # leases the newest job that is ready, returns (job_id, file_path, file_format) or None
+        # the newest run matters most for alerts, older files are processed after it
+        # files that are still being acquired are held back without using an attempt
+        while True:
+            job = self.claim_next(machine)
+            if job is None:
+                return None
+            job = (job[0], self.local_path(machine, job[1])) + job[2:]
+            if self.gate is None:
+                return job[:3]
+            stable, size, mtime = self.gate.check(job[1], job[3], job[4])
+            if stable:
+                return job[:3]
+            self.hold(job[0], size, mtime)
+
+    def local_path(self, machine, path):
+        # with in_dir the path was queued by another host, possibly another OS
+        if not self.in_dir:
+            return path
+        return os.path.join(self.in_dir, machine, path.replace("\\", "/").split("/")[-1])
+
+    def peek(self, machine, count):
+        # paths of the next jobs that would be claimed, without claiming them
+        with self.lock:
+            try:
+                self.db.cursor.execute("SELECT file_path FROM processing_job "
+                                       "WHERE machine_id = %s AND experiment_id = %s AND priority = %s AND ("
+                                       "(state = 'queued' AND (next_attempt IS NULL OR next_attempt <= NOW())) OR "
+                                       "(state = 'failed' AND attempts < %s AND next_attempt <= NOW())) "
+                                       "ORDER BY file_name DESC LIMIT %s",
+                                       (self.get_machine_id(machine), self.experiment_id, self.priority, self.max_attempts,
+                                        count))
+                paths = [self.local_path(machine, row[0]) for row in self.db.cursor.fetchall()]
+                self.db.db.commit()
+                return paths
+            except Exception as e:
+                self.db.db.rollback()
+                logger.exception(e)
+                return []
+
+    def claim_next(self, machine):
+        # leases the newest job that is queued, due for a retry or abandoned by a crashed process
+        # returns (job_id, file_path, file_format, file_size, file_mtime) or None
+        with self.lock:
+            try:
+                self.db.cursor.execute("SELECT job_id, file_path, file_format, file_size, file_mtime FROM processing_job "
+                                       "WHERE machine_id = %s AND experiment_id = %s AND priority = %s AND ("
+                                       "(state = 'queued' AND (next_attempt IS NULL OR next_attempt <= NOW())) OR "
+                                       "(state = 'failed' AND attempts < %s AND next_attempt <= NOW()) OR "
+                                       "(state = 'running' AND lease_expires < NOW())) "
+                                       "ORDER BY file_name DESC LIMIT 1 FOR UPDATE",
+                                       (self.get_machine_id(machine), self.experiment_id, self.priority, self.max_attempts))
+                job = self.db.cursor.fetchone()
+                if job is not None:
+                    self.db.cursor.execute("UPDATE processing_job SET state = 'running', attempts = attempts + 1, "
+                                           "lease_owner = %s, lease_expires = NOW() + INTERVAL %s SECOND, "
+                                           "heartbeat = NOW(), updated = NOW() WHERE job_id = %s",
+                                           (self.owner, self.lease, job[0]))
+                self.db.db.commit()
+                return job
+            except Exception as e:
+                self.db.db.rollback()
+                logger.exception(e)
+                return None
+
+    def ready(self, machine):
+        # number of jobs that could be claimed now
+        with self.lock:
+            try:
+                self.db.cursor.execute("SELECT COUNT(*) FROM processing_job "
+                                       "WHERE machine_id = %s AND experiment_id = %s AND priority = %s AND ("
+                                       "(state = 'queued' AND (next_attempt IS NULL OR next_attempt <= NOW())) OR "
+                                       "(state = 'failed' AND attempts < %s AND next_attempt <= NOW()) OR "
+                                       "(state = 'running' AND lease_expires < NOW()))",
+                                       (self.get_machine_id(machine), self.experiment_id, self.priority, self.max_attempts))
+                count = self.db.cursor.fetchone()[0]
+                self.db.db.commit()
+                return count
+            except Exception as e:
+                self.db.db.rollback()
+                logger.exception(e)
+                return 0
+
+    def mark_stale(self, machine):
+        # runs were inserted without the machine lock, the stats need updating by the lock holder
+        with self.lock:
+            try:
+                self.db.cursor.execute("INSERT IGNORE INTO stats_pending VALUES (%s, %s, NOW())",
+                                       (self.get_machine_id(machine), self.experiment_id))
+                self.db.db.commit()
+            except Exception as e:
+                self.db.db.rollback()
+                logger.exception(e)
+
+    def take_stale(self, machine):
+        # clears the mark before the stats are updated, True if there was one
+        # runs marked while the stats are updating mark the machine again
+        with self.lock:
+            try:
+                self.db.cursor.execute("DELETE FROM stats_pending WHERE machine_id = %s AND experiment_id = %s",
+                                       (self.get_machine_id(machine), self.experiment_id))
+                self.db.db.commit()
+                return self.db.cursor.rowcount > 0
+            except Exception as e:
+                self.db.db.rollback()
+                logger.exception(e)
+                return False
+
+    def hold(self, job_id, size, mtime):
+        # back to the queue for the quiet period, the claim doesn't count as an attempt
+        with self.lock:
+            try:
+                self.db.cursor.execute("UPDATE processing_job SET state = 'queued', attempts = attempts - 1, "
+                                       "file_size = %s, file_mtime = %s, lease_owner = NULL, lease_expires = NULL, "
+                                       "next_attempt = NOW() + INTERVAL %s SECOND, updated = NOW() WHERE job_id = %s",
+                                       (size, mtime, self.gate.quiet_period, job_id))
+                self.db.db.commit()
+            except Exception as e:
+                self.db.db.rollback()
+                logger.exception(e)
+
+    def complete(self, job_id):
+        self.finish(job_id, "done", None)
+
+    def fail(self, job_id, error="processing error"):
+        # retried after retry_delay, doubling with each attempt
+        self.finish(job_id, "failed", error)
+
+    def finish(self, job_id, state, error):
+        with self.lock:
+            try:
+                self.db.cursor.execute("UPDATE processing_job SET state = %s, last_error = %s, lease_owner = NULL, "
+                                       "lease_expires = NULL, updated = NOW(), "
+                                       "next_attempt = NOW() + INTERVAL (%s * POW(2, GREATEST(attempts - 1, 0))) SECOND "
+                                       "WHERE job_id = %s",
+                                       (state, error, self.retry_delay, job_id))
+                self.db.db.commit()
+            except Exception as e:
+                self.db.db.rollback()
+                logger.exception(e)
+
+
+class Heartbeat(threading.Thread):
+    """
+        Renews the leases of a JobQueue owner while it is processing
+        Uses its own pool connection as the queue connection is busy during processing
+    """
+    def __init__(self, queue, db_info):
+        threading.Thread.__init__(self, name="heartbeat", daemon=True)
+        self.owner = queue.owner
+        self.lease = queue.lease
+        self.db_info = db_info
+        self.stopped = threading.Event()
+
+    def run(self):
+        pool = get_pool(self.db_info)
+        db = pool.checkout()
+        while not self.stopped.wait(self.lease / 3):
+            try:
+                db.check()
+                db.cursor.execute("UPDATE processing_job SET heartbeat = NOW(), lease_expires = NOW() + INTERVAL %s SECOND "
+                                  "WHERE lease_owner = %s AND state = 'running'", (self.lease, self.owner))
+                db.cursor.execute("UPDATE machine_lock SET lease_expires = NOW() + INTERVAL %s SECOND "
+                                  "WHERE lease_owner = %s", (self.lease, self.owner))
+                db.db.commit()
+            except Exception as e:
+                logger.exception(e)
+        pool.checkin(db)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
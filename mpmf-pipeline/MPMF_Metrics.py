@@ -0,0 +1,241 @@
+# MaSpeQC - Quality control software for LC-MS/MS instrumentation
+#
+# Copyright (C) 2018-2025  Simon Caven
+# Copyright (C) 2020-2025  Monash University
+# Copyright (C) 2022-2025  University of Applied Sciences Mittweida
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import http.server
+import os
+import threading
+import logging
+from MPMF_Database_SetUp import get_pool
+logger = logging.getLogger('processing.metrics')
+
+# seconds, stages range from seconds (ingest) to an hour (mzmine on long runs)
+DURATION_BUCKETS = [1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600]
+
+# name -> (type, help)
+METRICS = {
+    "maspeqc_files_processed_total": ("counter", "QC files inserted"),
+    "maspeqc_files_failed_total": ("counter", "QC files that failed, by stage"),
+    "maspeqc_last_processed_timestamp_seconds": ("gauge", "Time the last QC file was inserted"),
+    "maspeqc_stage_duration_seconds": ("histogram", "Wall time of the processing stages of a QC file"),
+    "maspeqc_tool_runs_total": ("counter", "Runs of the external tools"),
+    "maspeqc_tool_failures_total": ("counter", "Failed runs of the external tools, by reason (exit or timeout)"),
+    "maspeqc_stat_duration_seconds": ("histogram", "Time to recompute the stats and normalised metrics"),
+    "maspeqc_chromatograms_inserted_total": ("counter", "Chromatograms inserted"),
+    "maspeqc_thermo_files_total": ("counter", "Raw files read for instrument metrics"),
+    "maspeqc_thermo_errors_total": ("counter", "Raw files that could not be read for instrument metrics"),
+    "maspeqc_jobs": ("gauge", "Jobs in the processing queue by state"),
+    "maspeqc_oldest_queued_job_age_seconds": ("gauge", "Age of the oldest queued job"),
+}
+
+
+class MetricsRegistry:
+    """
+        Counters, gauges and histograms of the pipeline, rendered as Prometheus text format
+        Fed by ProcessRawFile, ToolRunner, Stat, Chromatogram and ThermoMetrics
+        Worker processes hand their values to the main process with drain and merge
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # (name, labels) -> value, [bucket counts, sum, count] for histograms
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.values[self.key(name, labels)] = value
+
+    def observe(self, name, value, labels=None):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(DURATION_BUCKETS), 0.0, 0]
+            histogram = self.values[key]
+            for i in range(len(DURATION_BUCKETS)):
+                if value <= DURATION_BUCKETS[i]:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def drain(self):
+        # returns the values and starts again, used by worker processes
+        with self.lock:
+            values = self.values
+            self.values = {}
+        return values
+
+    def merge(self, values):
+        with self.lock:
+            for key in values:
+                metric_type = METRICS[key[0]][0]
+                if key not in self.values:
+                    self.values[key] = values[key]
+                elif metric_type == "counter":
+                    self.values[key] += values[key]
+                elif metric_type == "histogram":
+                    histogram = self.values[key]
+                    for i in range(len(DURATION_BUCKETS)):
+                        histogram[0][i] += values[key][0][i]
+                    histogram[1] += values[key][1]
+                    histogram[2] += values[key][2]
+                else:
+                    self.values[key] = values[key]
+
+    def clear(self, name):
+        # removes every series of a gauge before it is collected again
+        with self.lock:
+            for key in [key for key in self.values if key[0] == name]:
+                del self.values[key]
+
+    def render(self, labels=None):
+        # Prometheus text format, labels are added to every series
+        extra = list((labels or {}).items())
+        with self.lock:
+            series = {}
+            for key in self.values:
+                series.setdefault(key[0], []).append((key[1], self.values[key]))
+
+            lines = []
+            for name in METRICS:
+                if name not in series:
+                    continue
+                metric_type, description = METRICS[name]
+                lines.append("# HELP " + name + " " + description)
+                lines.append("# TYPE " + name + " " + metric_type)
+                for key_labels, value in sorted(series[name], key=lambda x: x[0]):
+                    key_labels = list(key_labels) + extra
+                    if metric_type == "histogram":
+                        for i in range(len(DURATION_BUCKETS)):
+                            lines.append(name + "_bucket" + format_labels(key_labels + [("le", str(DURATION_BUCKETS[i]))])
+                                         + " " + str(value[0][i]))
+                        lines.append(name + "_bucket" + format_labels(key_labels + [("le", "+Inf")]) + " " + str(value[2]))
+                        lines.append(name + "_sum" + format_labels(key_labels) + " " + repr(float(value[1])))
+                        lines.append(name + "_count" + format_labels(key_labels) + " " + str(value[2]))
+                    else:
+                        lines.append(name + format_labels(key_labels) + " " + repr(float(value)))
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(name + '="' + value + '"')
+    return "{" + ",".join(pairs) + "}"
+
+
+# metrics of this process
+registry = MetricsRegistry()
+
+
+class MetricsExporter:
+    """
+        Writes the pipeline metrics as Prometheus text format to a file (eg. for the node exporter
+        textfile collector) and/or serves them on a local HTTP port in watch mode
+        The job queue backlog is read from the database when the metrics are collected
+        Used by MPMF_Process_Raw_Files
+    """
+    def __init__(self, db_info, experiment_type, path="", port=0):
+        self.db_info = db_info
+        self.experiment = experiment_type.lower()
+        self.path = path
+        self.port = port
+        self.db = None
+        self.lock = threading.Lock()
+        self.server = None
+
+        if self.port:
+            exporter = self
+
+            class MetricsHandler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?")[0] not in ["/", "/metrics"]:
+                        self.send_error(404)
+                        return
+                    body = exporter.collect().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = http.server.ThreadingHTTPServer(("127.0.0.1", self.port), MetricsHandler)
+            threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+            logger.info("Serving metrics on http://127.0.0.1:" + str(self.port) + "/metrics")
+
+    def collect(self):
+        # reads the backlog and returns the metrics text
+        with self.lock:
+            try:
+                self.collect_backlog()
+            except (Exception, SystemExit) as e:  # MPMFDBSetUp exits when it can't connect
+                logger.exception(e)
+            return registry.render({"experiment": self.experiment})
+
+    def collect_backlog(self):
+        # own connection, the processing connection is busy
+        if self.db is None:
+            self.db = get_pool(self.db_info).checkout()
+        self.db.check()
+        self.db.cursor.execute("SELECT m.machine_name, j.state, COUNT(*), "
+                               "TIMESTAMPDIFF(SECOND, MIN(j.created), NOW()) FROM processing_job j "
+                               "JOIN machine m ON m.machine_id = j.machine_id "
+                               "JOIN experiment e ON e.experiment_id = j.experiment_id "
+                               "WHERE e.experiment_type = %s GROUP BY m.machine_name, j.state", (self.experiment,))
+        rows = self.db.cursor.fetchall()
+        self.db.db.commit()
+
+        registry.clear("maspeqc_jobs")
+        registry.clear("maspeqc_oldest_queued_job_age_seconds")
+        for machine, state, count, age in rows:
+            registry.set("maspeqc_jobs", count, {"machine": machine, "state": state})
+            if state == "queued":
+                registry.set("maspeqc_oldest_queued_job_age_seconds", age, {"machine": machine})
+
+    def write(self):
+        # replaces the metrics file in one step so it is never read half written
+        if not self.path:
+            return
+        text = self.collect()
+        try:
+            with open(self.path + ".tmp", "w") as f:
+                f.write(text)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logger.warning("Unable to write metrics file " + self.path + ": " + str(e))
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.db:
+            get_pool(self.db_info).checkin(self.db)
+            self.db = None
@@ -17,54 +17,109 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import argparse
+import concurrent.futures
 import datetime
-from decimal import getcontext, Decimal
-import glob
+from decimal import getcontext, Decimal, InvalidOperation
 import json
 import logging
+import logging.handlers
+import multiprocessing
 import os
 import platform
 import shutil
-import subprocess
 import sys
+import time
+import xml.etree.ElementTree as et
+import zipfile
+from MPMF_Catalog import FileCatalog
+from MPMF_Config import config, read_reference_db, read_thresholds
 from MPMF_File_System import FileSystem
-from MPMF_Database_SetUp import MPMFDBSetUp
-from MPMF_Stats import Stat
+import MPMF_Database_SetUp
+from MPMF_Database_SetUp import get_pool
+from MPMF_Metrics import registry, MetricsExporter
+from MPMF_Retention import Retention
 from MPMF_Chromatogram import Chromatogram
-from MPMF_Email import SendEmail
-from MPMF_Thermo_Metrics import ThermoMetrics
+from MPMF_Job_Queue import JobQueue, Heartbeat
+from MPMF_Scheduler import StageScheduler, Throttle
+from MPMF_Staging import create_stager, link_file
+from MPMF_Timing import StageTimer
+from MPMF_Tool_Runner import ToolRunner
+from MPMF_Watcher import RawFileWatcher
 getcontext().prec = 12
 
+# used when Config/pipeline-settings.json is missing a setting
+DEFAULT_SETTINGS = {
+    "Pipeline Queue Size": 2,
+    "Pipeline Workers": {"msconvert": 2, "mzmine": 1, "morpheus": 1, "ingest": 1},
+    "Watch Interval": 10,
+    "Watch Poll": False,
+    "Job Lease": 600,
+    "Job Retry Delay": 300,
+    "Job Max Attempts": 5,
+    "Stability Quiet Period": 15,
+    "Stability Handle Check": True,
+    "Tool Timeouts": {"msconvert": 1800, "mzmine": 3600, "morpheus": 3600},
+    "Tool Memory Limit": 0,
+    "Tool CPU Limit": 0,
+    "MZmine Batch Size": 1,
+    "Morpheus Batch Size": 1,
+    "Metrics File": "",
+    "Metrics Port": 0,
+    "Replay Threads": 4,
+    "Backfill Workers": 2,
+    "Backfill CPU Budget": 50,
+    "Backfill IO Budget": 0,
+    "Backfill Nice": 10,
+    "Database Pool Size": 4,
+    "Retention": {"mzML": "compress", "Chromatogram Files": "delete", "Morpheus Files": "keep"},
+    "Scratch Dir": "",
+    "Prefetch Files": 2,
+    "mzML Hand-off": "link",
+    "Bulk Load": False
+}
+
 # LOGGING
-# create module logger 
+# create module logger, handlers are added by init_logging
 logger = logging.getLogger('processing')
 logger.setLevel(logging.DEBUG)
 
-# create file handler which logs even debug messages
-fh = logging.FileHandler('processing.log')
-fh.setLevel(logging.DEBUG)
+# set in worker processes, shared by the stats of different machines
+thresholds_lock = None
+
+
+def init_logging():
+    # logs to processing.log and the console, called when run as a script instead of on import
+    MPMF_Database_SetUp.init_logging()
+    if logger.handlers:
+        return
+
+    # create file handler which logs even debug messages, the file is opened with the first record
+    fh = logging.FileHandler('processing.log', delay=True)
+    fh.setLevel(logging.DEBUG)
 
-# create console handler with a higher log level
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
+    # create console handler with a higher log level
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
 
-# create formatter and add it to the handlers
-formatter = logging.Formatter('%(levelname)s - %(name)s - %(asctime)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
-fh.setFormatter(formatter)
-ch.setFormatter(formatter)
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter('%(levelname)s - %(name)s - %(asctime)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+    fh.setFormatter(formatter)
+    ch.setFormatter(formatter)
 
-# add the handlers to the logger
-logger.addHandler(fh)
-logger.addHandler(ch)
+    # add the handlers to the logger
+    logger.addHandler(fh)
+    logger.addHandler(ch)
 
 
 class ProcessRawFile:
     """
         Processes a single raw file
         Inserts metric data into database
-        Uses SendEmail and Stat
+        Uses SendEmail
     """
-    def __init__(self, file_name, file_path, machine, e_type, filesystem, db_info, email, machine_type, file_format):
+    def __init__(self, file_name, file_path, machine, e_type, filesystem, db_info, email, machine_type, file_format,
+                 settings=None):
 
         self.experiment = e_type.upper()
         self.machine = machine
@@ -72,128 +127,176 @@ class ProcessRawFile:
         self.fs = filesystem
         self.send_email = email
         self.machine_type = machine_type
-        self.db = MPMFDBSetUp(db_info["user"], db_info["password"], db_info["database"], self.fs, db_info["port"])
+        settings = settings or DEFAULT_SETTINGS
+        self.pool = get_pool(db_info, settings["Database Pool Size"])
+        self.db = self.pool.checkout(self.fs)
+        self.closed = False
         self.raw_file = file_path
         self.file_format = file_format
         self.metadata = {'filename': self.file_name, 'experiment': self.experiment, 'machine': self.machine}
         self.outfiles_dir = os.path.join(self.fs.out_dir, self.experiment, self.machine, self.file_name)
         self.morph_out_dir = os.path.join(self.outfiles_dir, "Morpheus")
+        self.tools = ToolRunner(settings["Tool Timeouts"], settings["Tool Memory Limit"], settings["Tool CPU Limit"])
+        self.timer = StageTimer(self.tools, self.machine)
+        self.skipped = None  # reason the file is not processed, set by convert (not an error)
+        self.retention = settings["Retention"]
+        self.mzml_hand_off = settings["mzML Hand-off"]
 
-        # make and set folder for outfiles
-        os.chdir(self.fs.out_dir)
+        # make folder for outfiles
         if not os.path.isdir(self.outfiles_dir):
-            os.makedirs(os.path.join(self.experiment, self.machine, self.file_name))
-
-    # RUN
-    def run(self):
-        # check if a QC file and not inserted
-        check_run = False
-        if self.check_file_name():
-            if not self.check_run():
-                # convert raw file
-                if self.run_msconvert():
-                    # create xml
-                    if self.experiment == "METABOLOMICS":
-                        self.create_metab_xml()
-                    elif self.experiment == "PROTEOMICS":
-                        self.create_proteo_xml()
-                    if self.run_mzmine():
-                        if self.insert_qc_run_data():
-                            if self.experiment == "METABOLOMICS":
-                                self.insert_pos_csv()
-                                self.insert_neg_csv()
-                                self.fwhm_to_seconds()
-                                email_data = self.check_email_thresholds_metab()
-                                self.insert_summary(email_data)
-                                if self.send_email:
-                                    if len(email_data) > 0:
-                                        email_data['metadata'] = self.metadata
-                                        SendEmail(email_data, self.db, self.fs)
-                                    else:
-                                        logger.info("No Thresholds breached, No Email Sent")
-                                logger.info("Inserted Data for " + self.machine + " " + self.file_name)
-                                check_run = True
-                            elif self.experiment == "PROTEOMICS":
-                                self.insert_pos_csv()
-                                self.fwhm_to_seconds()
-                                if self.run_morpheus():
-                                    self.insert_morpheus()
-                                    email_data = self.check_email_thresholds_prot()
-                                    self.insert_summary(email_data)
-                                    if self.send_email:
-                                        if len(email_data) > 0:
-                                            email_data['metadata'] = self.metadata
-                                            SendEmail(email_data, self.db, self.fs)
-                                        else:
-                                            logger.info("No Thresholds breached, No Email Sent")
-                                    logger.info("Inserted Data for " + self.machine + " " + self.file_name)
-                                    check_run = True
-                                else:
-                                    self.delete_run()
-                                    logger.error("Morpheus error " + self.file_name)
-                        else:
-                            logger.error("Insert run details error " + self.file_name)
-                    else:
-                        logger.error("mzMine: processing error " + self.file_name)
-                else:
-                    logger.error("msconvert: file too small or still writing  " + self.file_name)
-            else:
+            os.makedirs(self.outfiles_dir)
+
+    # STAGES
+    # called in order by process_jobs or by the StageScheduler in pipeline mode (run_pipeline)
+    # tools are run with their own working directory so stages can run in threads
+    def convert(self):
+        with self.timer.stage("msconvert"):
+            # check if a QC file and not inserted
+            if not self.check_file_name():
+                logger.error("Incorrect file format " + self.file_name)
+                self.skipped = "incorrect file format"
+                return False
+
+            if self.check_run():
                 logger.info("Already Inserted " + self.file_name)
-        else:
-            logger,error("Incorrect file format " + self.file_name)
+                self.skipped = "already inserted"
+                return False
 
-        os.chdir(self.fs.main_dir)
-        
-        # close database conn. and cursor
-        self.db.cursor.close()
-        self.db.db.close()
-        
-        return check_run
+            # convert raw file
+            if not self.run_msconvert():
+                logger.error("msconvert: file too small or still writing  " + self.file_name)
+                registry.inc("maspeqc_files_failed_total", {"machine": self.machine, "stage": "msconvert"})
+                return False
 
-    def run_mzmine(self):
+            # create xml
+            if self.experiment == "METABOLOMICS":
+                self.create_metab_xml()
+            elif self.experiment == "PROTEOMICS":
+                self.create_proteo_xml()
 
-        # check platform for loc and command
-        platform_sys = platform.system()
+            return True
+
+    def process_mzmine(self):
+        with self.timer.stage("mzmine"):
+            if not self.run_mzmine():
+                logger.error("mzMine: processing error " + self.file_name)
+                registry.inc("maspeqc_files_failed_total", {"machine": self.machine, "stage": "mzmine"})
+                return False
+
+            return True
+
+    def search(self):
+        # morpheus search (proteomics only)
+        if self.experiment == "PROTEOMICS":
+            with self.timer.stage("morpheus"):
+                if not self.run_morpheus():
+                    logger.error("Morpheus error " + self.file_name)
+                    registry.inc("maspeqc_files_failed_total", {"machine": self.machine, "stage": "morpheus"})
+                    return False
+
+        return True
+
+    def ingest(self):
+        # the connection may have timed out while the tools were running
+        self.db.check()
+        with self.timer.stage("ingest"):
+            # insert run and metrics, check thresholds and send email
+            if not self.insert_qc_run_data():
+                logger.error("Insert run details error " + self.file_name)
+                registry.inc("maspeqc_files_failed_total", {"machine": self.machine, "stage": "ingest"})
+                return False
+
+            csv_files = ["posoutput.csv", "negoutput.csv"] if self.experiment == "METABOLOMICS" else ["posoutput.csv"]
+            if not self.insert_mzmine_csv(csv_files):
+                # no run without its measurements, the job is failed and retried
+                logger.error("Insert measurements error " + self.file_name)
+                self.delete_run()
+                registry.inc("maspeqc_files_failed_total", {"machine": self.machine, "stage": "ingest"})
+                return False
+
+            email_data = {}
+            if self.experiment == "METABOLOMICS":
+                email_data = self.check_email_thresholds_metab()
+            elif self.experiment == "PROTEOMICS":
+                self.insert_morpheus()
+                email_data = self.check_email_thresholds_prot()
+
+            self.insert_summary(email_data)
+            if self.send_email:
+                if len(email_data) > 0:
+                    email_data['metadata'] = self.metadata
+                    from MPMF_Email import SendEmail  # BeautifulSoup is only loaded to send an email
+                    SendEmail(email_data, self.db, self.fs)
+                else:
+                    logger.info("No Thresholds breached, No Email Sent")
+            logger.info("Inserted Data for " + self.machine + " " + self.file_name)
+            registry.inc("maspeqc_files_processed_total", {"machine": self.machine})
+            registry.set("maspeqc_last_processed_timestamp_seconds", time.time(), {"machine": self.machine})
+
+            return True
 
-        mzmine_loc = ''
-        mzmine_command = ''
+    def replay(self):
+        # inserts a run from the MZmine and Morpheus output already in OutFiles, without running the tools
+        if not self.check_file_name():
+            return False
+
+        if self.check_run():
+            logger.info("Already Inserted " + self.file_name)
+            return False
+
+        if not self.has_mzmine_output():
+            logger.warning("No MZmine output to replay for " + self.file_name)
+            return False
+
+        if self.experiment == "PROTEOMICS" and not os.path.isfile(os.path.join(self.morph_out_dir, "summary.tsv")):
+            logger.warning("No Morpheus output to replay for " + self.file_name)
+            return False
+
+        return self.ingest()
+
+    def close(self):
+        # return the database connection to the pool
+        if not self.closed:
+            self.closed = True
+            self.pool.checkin(self.db)
+
+    def get_mzmine_loc(self):
+        # returns (folder, start script) of MZmine for the platform, None if unknown
+        platform_sys = platform.system()
         if platform_sys == 'Windows':
-            mzmine_loc = 'MZmine-2.53-Windows'
-            mzmine_command = 'startMZmine-Windows.bat '
+            return 'MZmine-2.53-Windows', 'startMZmine-Windows.bat '
         elif platform_sys == 'Linux':
-            mzmine_loc = 'MZmine-2.53-Linux'
-            mzmine_command = 'startMZmine-Linux.bat '
+            return 'MZmine-2.53-Linux', 'startMZmine-Linux.bat '
         elif platform_sys == 'Darwin':
-            mzmine_loc = 'MZmine-2.53-macOS'
-            mzmine_command = 'startMZmine-macOS.bat '
+            return 'MZmine-2.53-macOS', 'startMZmine-macOS.bat '
+        return None
 
-        if mzmine_loc == '':
+    def run_mzmine(self, batch_xml=None, timeout=None):
+        # runs the batch file of this run, or a batch file covering several runs (see process_mzmine_batch)
+        mzmine_loc = self.get_mzmine_loc()
+        if mzmine_loc is None:
             logger.error("Unable to determine platform for mzMine")
             return False
-        
-        os.chdir(os.path.join(self.fs.sw_dir, mzmine_loc))
-        command = mzmine_command + '"' + str(os.path.join(self.outfiles_dir, self.file_name + ".xml")) + '"'
-        returnvalue = os.system(command)
-        if returnvalue:
-            return False
-        else:
-            return True
 
-    def run_mzmine_sub(self):
-        # using subprocess if needed
-        os.chdir(os.path.join(self.fs.sw_dir, "MZmine-2.53-Windows"))
-        p = subprocess.Popen(['startMZmine-Windows.bat',  str(os.path.join(self.outfiles_dir, self.file_name + ".xml"))], stdout=subprocess.PIPE)
-        p.communicate()
-        returnvalue = p.poll()
-        # backward logic!
-        if returnvalue:
-            return False
-        else:
-            return True
+        if batch_xml is None:
+            batch_xml = os.path.join(self.outfiles_dir, self.file_name + ".xml")
+        command = mzmine_loc[1] + '"' + str(batch_xml) + '"'
+        return self.tools.run("mzmine", command, os.path.join(self.fs.sw_dir, mzmine_loc[0]), timeout)
+
+    def has_mzmine_output(self):
+        # csv files written by the CSVExport steps of the batch
+        outputs = ["posoutput.csv"]
+        if self.experiment == "METABOLOMICS":
+            outputs.append("negoutput.csv")
+        for output in outputs:
+            if not os.path.isfile(os.path.join(self.outfiles_dir, output)):
+                return False
+        return True
 
-    def run_morpheus(self):
+    def run_morpheus(self, data_files=None, out_dir=None, timeout=None):
 
         # runs morpheus for windows only
+        # searches the _pos.mzML of this run, or several data files at once (see search_morpheus_batch)
         # needs .NET 4.5 or higher and MSFileReader x86
         # NOTE: morpheus uses relative paths, current method for out folder
         #        removes C: (by splicing below) which means the path starts with /
@@ -209,15 +312,18 @@ class ProcessRawFile:
 
         # software location
         morph_dir = os.path.join(self.fs.sw_dir, "Morpheus (mzML)")
-        os.chdir(morph_dir)
 
-        if not os.path.isdir(self.morph_out_dir):
-            os.makedirs(self.morph_out_dir)
+        if data_files is None:
+            data_files = [self.pos_file]
+        if out_dir is None:
+            out_dir = self.morph_out_dir
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
 
         # cl options
         options = {
-                '-d': self.pos_file,
-                '-o': self.morph_out_dir,
+                '-d': ",".join(data_files),
+                '-o': out_dir,
                 '-db': morph_db,
                 '-ad': 'true',
                 '-mmu': 'true',
@@ -244,45 +350,50 @@ class ProcessRawFile:
 
 
         # run morpheus
-        returnvalue = os.system(command)
-        if returnvalue:
-            return False
-        else:
-            return True
+        return self.tools.run("morpheus", command, morph_dir, timeout)
 
     def run_msconvert(self):
         '''Creates .mzML files in OutFiles'''
 
-        # copy mzML files for proteomics (don't convert)
+        # mzML files for proteomics are not converted, _pos.mzML is linked to the file where possible
+        # the tools keep reading _pos.mzML as Morpheus and the chromatograms name their output after it
         if self.file_format == ".mzML":
             if self.experiment == "PROTEOMICS":
-                shutil.copy(self.raw_file, self.outfiles_dir)
-                os.chdir(self.outfiles_dir)
-                os.rename(self.file_name + ".mzML", self.file_name + "_pos" + ".mzML")
+                pos_file = os.path.join(self.outfiles_dir, self.file_name + "_pos" + ".mzML")
+                if self.mzml_hand_off == "link":
+                    logger.debug("mzML hand-off by " + link_file(self.raw_file, pos_file) + " for " + self.file_name)
+                else:
+                    shutil.copy(self.raw_file, pos_file)
                 return True
 
 
-        # go to s/w location
-        os.chdir(os.path.join(self.fs.sw_dir, "ProteoWizard"))
-
-        # convert positive
-        command = 'msconvert ' + '"' + self.raw_file + '"' \
-                  + ' --filter ' + '"peakPicking true 1-"' + ' --filter ' + '"polarity positive"' \
-                  + ' --mzML -o ' + '"' + self.outfiles_dir + '"' + ' --outfile ' + '"' + self.file_name \
-                  + '"' + '_pos'
-        returnvalue = os.system(command)
-        if returnvalue:
-            return False
+        # s/w location
+        msconvert_dir = os.path.join(self.fs.sw_dir, "ProteoWizard")
 
+        polarities = ["positive"]
         if self.experiment == "METABOLOMICS":
-            # run negative
+            polarities.append("negative")
+
+        # msconvert writes one polarity per run, run them at the same time
+        processes = {}
+        for polarity in polarities:
             command = 'msconvert ' + '"' + self.raw_file + '"' \
-                      + ' --filter ' + '"peakPicking true 1-"' + ' --filter ' + '"polarity negative"' \
+                      + ' --filter ' + '"peakPicking true 1-"' + ' --filter ' + '"polarity ' + polarity + '"' \
                       + ' --mzML -o ' + '"' + self.outfiles_dir + '"' + ' --outfile ' + '"' + self.file_name \
-                      + '"' + '_neg'
-            returnvalue = os.system(command)
-            if returnvalue:
-                return False
+                      + '"' + '_' + polarity[:3]
+            processes[polarity] = self.tools.start("msconvert", command, msconvert_dir)
+
+        failed = []
+        for polarity in polarities:
+            if not self.tools.finish(processes[polarity]):
+                failed.append(polarity)
+                # no use finishing the other polarity
+                for other in polarities:
+                    processes[other].kill()
+
+        if failed:
+            logger.error("msconvert: " + ", ".join(failed) + " conversion failed for " + self.file_name)
+            return False
 
         return True
 
@@ -335,7 +446,6 @@ class ProcessRawFile:
         neg_output_file = os.path.join(self.outfiles_dir, "negoutput.csv")
 
         new_xml = []
-        os.chdir(self.fs.main_dir)
         with open(self.fs.xml_template_metab, 'r') as infile:
             for line in infile:
                 new_line = line.strip()
@@ -361,7 +471,6 @@ class ProcessRawFile:
         pos_output_file = os.path.join(self.outfiles_dir, "posoutput.csv")
 
         new_xml = []
-        os.chdir(self.fs.main_dir)
         with open(self.fs.xml_template_proteo, 'r') as infile:
             for line in infile:
                 new_line = line.strip()
@@ -375,6 +484,40 @@ class ProcessRawFile:
             for line in new_xml:
                 outfile.write(line + "\n")
 
+    def collect_morpheus_output(self, batch_dir, header, rows):
+        # moves the output of this run from a batch search into its own Morpheus folder
+        # summary.tsv of a batch has one row per data file, the run gets a summary.tsv with its own row
+        pos_name = self.file_name + "_pos."
+        row = None
+        for line in rows:
+            if os.path.basename(line.split("\t")[0].strip()).startswith(pos_name):
+                row = line
+        if row is None or not os.path.isfile(os.path.join(batch_dir, pos_name + "PSMs.tsv")):
+            return False
+
+        if not os.path.isdir(self.morph_out_dir):
+            os.makedirs(self.morph_out_dir)
+        for name in os.listdir(batch_dir):
+            if name.startswith(pos_name):
+                shutil.move(os.path.join(batch_dir, name), os.path.join(self.morph_out_dir, name))
+        with open(os.path.join(self.morph_out_dir, "summary.tsv"), "w") as outfile:
+            outfile.write(header)
+            outfile.write(row)
+
+        return True
+
+    def get_mzmine_steps(self):
+        # batch steps of the batch file of this run, without saving the project
+        root = et.parse(os.path.join(self.outfiles_dir, self.file_name + ".xml")).getroot()
+        steps = []
+        project_step = None
+        for step in root.findall("batchstep"):
+            if step.get("method").endswith("ProjectSaveModule"):
+                project_step = step
+            else:
+                steps.append(step)
+        return steps, project_step
+
     # INSERT
     def insert_morpheus(self):
 
@@ -393,25 +536,15 @@ class ProcessRawFile:
         run_id = self.db.get_run_id(self.file_name)
 
         # get hela component_id
-        sql = "SELECT component_id FROM sample_component WHERE component_name = 'Hela Digest'"
-        try:
-            self.db.cursor.execute(sql)
-            hela_id = self.db.cursor.fetchone()[0]
-        except Exception as e:
-            logger.exception(e)
+        hela_id = self.db.get_component_id('Hela Digest')
 
         for key in summary:
             # get metric_id
-            sql = "SELECT metric_id FROM metric WHERE metric_name = '" + key.strip() + "'"
-            try:
-                self.db.cursor.execute(sql)
-                met_id = self.db.cursor.fetchone()
-            except Exception as e:
-                logger.exception(e)
+            met_id = self.db.get_metric_id(key.strip())
 
             # insert measurement
             if met_id is not None:
-                sql = "INSERT INTO measurement VALUES ( '" + str(met_id[0]) + "','" + str(hela_id) + \
+                sql = "INSERT INTO measurement VALUES ( '" + str(met_id) + "','" + str(hela_id) + \
                       "','" + str(run_id) + "','" + str(summary[key]) + "')"
 
                 try:
@@ -462,15 +595,10 @@ class ProcessRawFile:
 
 
         # get id for Precursor Mass Error
-        sql = "SELECT metric_id FROM metric WHERE metric_name = 'Precursor Mass Error'"
-        try:
-            self.db.cursor.execute(sql)
-            mid = self.db.cursor.fetchone()
-        except Exception as e:
-            logger.exception(e)
+        mid = self.db.get_metric_id('Precursor Mass Error')
 
         # insert
-        sql = "INSERT INTO measurement VALUES ( '" + str(mid[0]) + "','" + str(hid) + \
+        sql = "INSERT INTO measurement VALUES ( '" + str(mid) + "','" + str(hid) + \
               "','" + str(rid) + "','" + str(average) + "')"
 
         try:
@@ -480,135 +608,80 @@ class ProcessRawFile:
 
         self.db.db.commit()
 
-    def insert_pos_csv(self):
-        # insert pos for v4
-        # relies on INSERT ORDER (from DB) REFACTOR?
-        # mz, rt, height, area, fwhm, tf, af, min, max, (ppm), (dalton), (areaN), (heightN)
-        # change metric names in xml templates and rewrite all insert functions to use names
-
-        run_id = self.db.get_run_id(self.file_name)
-
-        with open(os.path.join(self.outfiles_dir, "posoutput.csv"), "r") as incsv:
-            for line in incsv:
-                in_data = line.strip().split("|")
-                if in_data[0][0] != 'r': # skip first line
-                    sql = "SELECT component_id FROM sample_component WHERE component_name = " + "'" + in_data[0] + "'"
-                    try:
-                        self.db.cursor.execute(sql)
-                        comp_id = self.db.cursor.fetchone()
-                    except Exception as e:
-                        logger.exception(e)
-
-                    for i in range(1, 10): # watch i as metric id here REFACTOR change metric names to mzmine and get ids
-                        # handle nulls, put to 0, other values ??
-                        ins_value = str(in_data[i])
-                        if ins_value == 'null':
-                            ins_value = '0'
-                        ins_sql = "INSERT INTO measurement VALUES( " + "'" + str(i) + "', '" + str(comp_id[0]) \
-                                  + "', '" + str(run_id) + "', '" + ins_value + "')"
-                        try:
-                            self.db.cursor.execute(ins_sql)
-                            self.db.db.commit()
-                        except Exception as e:
-                            logger.exception(e)
-
-                    self.insert_derived_errors(run_id, comp_id[0])
-
-    def insert_neg_csv(self):
-        # insert neg for v4
-        # INSERT ORDER (from DB)
-        # mz, rt, height, area, fwhm, tf, af, min, max, ppm, dalton, areaN, heightN
-
-        # get run_id
+    def insert_mzmine_csv(self, csv_files):
+        # inserts the MZmine output of the run with one multi-row insert and a single commit
+        # INSERT ORDER (from DB), the csv column is the metric id
+        # mz, rt, height, area, fwhm, tf, af, min, max, then ppm and dalton errors computed from mz
+        # fwhm is converted from minutes to seconds before inserting
         run_id = self.db.get_run_id(self.file_name)
+        fwhm_id = self.db.get_metric_id("fwhm")
 
-        with open(os.path.join(self.outfiles_dir, "negoutput.csv"), "r") as incsv:
-            for line in incsv:
-                in_data = line.strip().split("|")
-                if in_data[0][0] != 'r': # skip first line
-                    sql = "SELECT component_id FROM sample_component WHERE component_name = " + "'" + in_data[0] + "'"
-                    try:
-                        self.db.cursor.execute(sql)
-                        comp_id = self.db.cursor.fetchone()
-                    except Exception as e:
-                        logger.exception(e)
-
-                    for i in range(1, 10):
-                        # handle nulls, put to 0, other values ??
-                        ins_value = str(in_data[i])
-                        if ins_value == 'null':
-                            ins_value = '0'
-                        ins_sql = "INSERT INTO measurement VALUES( " + "'" + str(i) + "', '" + str(comp_id[0]) \
-                                  + "', '" + str(run_id) + "', '" + ins_value + "')"
-                        try:
-                            self.db.cursor.execute(ins_sql)
-                            self.db.db.commit()
-                        except Exception as e:
-                            logger.exception(e)
-
-                    self.insert_derived_errors(run_id, comp_id[0])
-
-    def insert_derived_errors(self, r_id, c_id):
-        sql = "SELECT exp_mass_charge FROM sample_component WHERE component_id = " + str(c_id)
+        # component name -> (component_id, exp_mass_charge)
         try:
-            self.db.cursor.execute(sql)
-            emc = self.db.cursor.fetchone()
+            self.db.cursor.execute("SELECT component_name, component_id, exp_mass_charge FROM sample_component")
+            components = {row[0]: (row[1], row[2]) for row in self.db.cursor.fetchall()}
         except Exception as e:
             logger.exception(e)
+            return False
 
+        values = {}  # (metric_id, component_id) -> value, the first one is kept if a component repeats
+        for csv_file in csv_files:
+            with open(os.path.join(self.outfiles_dir, csv_file), "r") as incsv:
+                for line in incsv:
+                    in_data = line.strip().split("|")
+                    if in_data[0][:1] == 'r':  # skip first line
+                        continue
+                    if in_data[0] not in components:
+                        logger.warning("Unknown component " + in_data[0] + " in " + csv_file)
+                        continue
+                    comp_id, emc = components[in_data[0]]
+                    if (1, comp_id) in values:
+                        continue
 
-        sql2 = "SELECT value FROM measurement WHERE component_id = " + str(c_id) + " AND run_id = " \
-               + str(r_id) + " AND metric_id = 1"
-        try:
-            self.db.cursor.execute(sql2)
-            m_value = self.db.cursor.fetchone()
-        except Exception as e:
-            logger.exception(e)
-
-        # data type nightmare c/o mysql and python
-        diff = Decimal(m_value[0]) - Decimal(emc[0])
-        ppm = (diff/emc[0]) * Decimal(1e6)
-        dalton = diff * Decimal(1e3)
-
-        ins_sql1 = "INSERT INTO measurement VALUES( " + "'" + "10" + "', '" + str(c_id) \
-                                    + "', '" + str(r_id) + "', '" + str(ppm) + "')"
-
-        ins_sql2 = "INSERT INTO measurement VALUES( " + "'" + "11" + "', '" + str(c_id) \
-                   + "', '" + str(r_id) + "', '" + str(dalton) + "')"
+                    # a bad row is left out, the other components of the run are still inserted
+                    try:
+                        row = {}
+                        for i in range(1, 10):
+                            value = csv_value(in_data[i])
+                            if i == fwhm_id:
+                                value = value * 60
+                            row[(i, comp_id)] = value
+
+                        # derived errors
+                        diff = row[(1, comp_id)] - emc
+                        row[(10, comp_id)] = (diff / emc) * Decimal(1e6)
+                        row[(11, comp_id)] = diff * Decimal(1e3)
+
+                        # DECIMAL(36, 18) holds values below 10^18
+                        for value in row.values():
+                            if value.adjusted() >= 18:
+                                raise ValueError("value " + str(value) + " out of range")
+                    except (IndexError, ValueError, ArithmeticError) as e:
+                        logger.warning("Skipping " + in_data[0] + " in " + csv_file + ": " + repr(e))
+                        continue
+                    values.update(row)
 
+        rows = [(metric_id, comp_id, run_id, value) for (metric_id, comp_id), value in values.items()]
         try:
-            self.db.cursor.execute(ins_sql1)
-            self.db.cursor.execute(ins_sql2)
+            self.db.insert_rows("measurement", rows)
             self.db.db.commit()
         except Exception as e:
             logger.exception(e)
+            self.db.db.rollback()
+            return False
+        return True
 
     def insert_qc_run_data(self):
 
-        # get id for experiment
-        e_sql = "SELECT experiment_id FROM experiment WHERE experiment_type = '" + self.experiment.lower() + "'"
-
-        try:
-            self.db.cursor.execute(e_sql)
-            eid = self.db.cursor.fetchone()
-            self.eid = eid[0] # store for stats
-        except Exception as e:
-            logger.exception(e)
-
-        # get machine id
-        m_sql = "SELECT machine_id FROM machine WHERE machine_name = " + "'" + self.machine + "'"
-
-        try:
-            self.db.cursor.execute(m_sql)
-            self.mid = self.db.cursor.fetchone() # store machine id
-        except Exception as e:
-            logger.exception(e)
+        # get id for experiment and machine, stored for stats
+        self.eid = self.db.get_experiment_id(self.experiment.lower())
+        self.mid = self.db.get_machine_id(self.machine)
 
 
         run_date = self.get_run_date_time()
 
         sql = "INSERT INTO qc_run(run_id, file_name, date_time, machine_id, experiment_id, completed) VALUES(NULL,'" \
-              + self.file_name + "', CONVERT('" + str(run_date) + "', DATETIME)" + ",'" + str(self.mid[0]) + \
+              + self.file_name + "', CONVERT('" + str(run_date) + "', DATETIME)" + ",'" + str(self.mid) + \
                "','" + str(self.eid) + "','N'" + ")"
         try:
             self.db.cursor.execute(sql)
@@ -640,31 +713,10 @@ class ProcessRawFile:
         # and sends email if any outsdide limits
         
         # get db (exp. retention times)
-        with open(self.fs.irt_db) as f:
-            pos_db = f.readlines()
-        
-        # remove header
-        pos_db.pop(0)
-            
-        # create dict for storing
-        pos_samples = {}
-        for sample in pos_db:
-            new_sample = sample.split("|")
-            pos_samples[new_sample[2].strip()] = float(new_sample[1])
+        pos_samples = read_reference_db(self.fs.irt_db)
 
         # get threshold limits
-        with open(self.fs.thresh_email) as f:
-            limits = f.readlines()
-
-        # remove header
-        limits.pop(0)
-
-        # create dict for storing
-        thresholds = {}
-        for limit in limits:
-            new_limit = limit.split("|")
-            if new_limit[1] != '':
-                thresholds[new_limit[0]] = [new_limit[1], new_limit[2], new_limit[3].strip()]
+        thresholds = read_thresholds(self.fs.thresh_email)
 
         # get run_id
         run_id = self.db.get_run_id(self.file_name)
@@ -678,9 +730,7 @@ class ProcessRawFile:
             upper = thresholds[metric][2]
 
             # get metric_id
-            sql = "SELECT metric_id FROM metric WHERE metric_name = " + "'" + metric + "'"
-            self.db.cursor.execute(sql)
-            metric_id = self.db.cursor.fetchone()[0]
+            metric_id = self.db.get_metric_id(metric)
 
             # get values for metric and run_id
             sql = "SELECT c.component_name, v.value FROM " + \
@@ -740,7 +790,7 @@ class ProcessRawFile:
                 sql = "SELECT m.value FROM measurement m, qc_run q WHERE m.metric_id = " + "'" + str(metric_id) + "'" + \
                       " AND m.run_id = q.run_id AND " + \
                       " q.experiment_id = '" + str(self.eid) + "'" +\
-                      " AND q.machine_id = " + str(self.mid[0]) + \
+                      " AND q.machine_id = " + str(self.mid) + \
                       " ORDER by m.value"
                 self.db.cursor.execute(sql)
                 all_results = self.db.cursor.fetchall()
@@ -763,7 +813,7 @@ class ProcessRawFile:
                 sql = "SELECT m.value FROM measurement m, qc_run q WHERE m.metric_id = " + "'" + str(metric_id) + "'" + \
                       " AND m.run_id = q.run_id AND " + \
                       " q.experiment_id = '" + str(self.eid) + "'" +\
-                      " AND q.machine_id = " + str(self.mid[0]) + \
+                      " AND q.machine_id = " + str(self.mid) + \
                       " ORDER by m.value"
                 self.db.cursor.execute(sql)
                 all_results = self.db.cursor.fetchall()
@@ -783,7 +833,7 @@ class ProcessRawFile:
                 sql = "SELECT m.value FROM measurement m, qc_run q WHERE m.metric_id = " + "'" + str(metric_id) + "'" + \
                       " AND m.run_id = q.run_id AND " + \
                       " q.experiment_id = '" + str(self.eid) + "'" +\
-                      " AND q.machine_id = " + str(self.mid[0]) + \
+                      " AND q.machine_id = " + str(self.mid) + \
                       " ORDER by m.value"
                 self.db.cursor.execute(sql)
                 all_results = self.db.cursor.fetchall()
@@ -803,7 +853,7 @@ class ProcessRawFile:
                 sql = "SELECT m.value FROM measurement m, qc_run q WHERE m.metric_id = " + "'" + str(metric_id) + "'" + \
                       " AND m.run_id = q.run_id AND " + \
                       " q.experiment_id = '" + str(self.eid) + "'" +\
-                      " AND q.machine_id = " + str(self.mid[0]) + \
+                      " AND q.machine_id = " + str(self.mid) + \
                       " ORDER by m.value"
                 self.db.cursor.execute(sql)
                 all_results = self.db.cursor.fetchall()
@@ -850,43 +900,11 @@ class ProcessRawFile:
     def check_email_thresholds_metab(self):
     
         # get neg and pos databases (exp. retention times)
-        with open(self.fs.pos_db) as f:
-            pos_db = f.readlines()
-            
-        with open(self.fs.neg_db) as f:
-            neg_db = f.readlines()
-        
-        # remove header
-        neg_db.pop(0)
-            
-        # create dict for storing
-        neg_samples = {}
-        for sample in neg_db:
-            new_sample = sample.split("|")
-            neg_samples[new_sample[2].strip()] = float(new_sample[1])
-            
-         # remove header
-        pos_db.pop(0)
-            
-        # create dict for storing
-        pos_samples = {}
-        for sample in pos_db:
-            new_sample = sample.split("|")
-            pos_samples[new_sample[2].strip()] = float(new_sample[1])
+        pos_samples = read_reference_db(self.fs.pos_db)
+        neg_samples = read_reference_db(self.fs.neg_db)
 
         # get threshold limits
-        with open(self.fs.thresh_email) as f:
-            limits = f.readlines()
-
-        # remove header
-        limits.pop(0)
-
-        # create dict for storing
-        thresholds = {}
-        for limit in limits:
-            new_limit = limit.split("|")
-            if new_limit[1] != '':
-                thresholds[new_limit[0]] = [new_limit[1], new_limit[2], new_limit[3].strip()]
+        thresholds = read_thresholds(self.fs.thresh_email)
 
         # get run_id
         run_id = self.db.get_run_id(self.file_name)
@@ -899,9 +917,7 @@ class ProcessRawFile:
             upper = thresholds[metric][2]
 
             # get metric_id
-            sql = "SELECT metric_id FROM metric WHERE metric_name = " + "'" + metric + "'"
-            self.db.cursor.execute(sql)
-            metric_id = self.db.cursor.fetchone()[0]
+            metric_id = self.db.get_metric_id(metric)
 
             # get values for metric and run_id (not limited by polarity)
             sql = "SELECT c.component_name, v.value FROM " + \
@@ -983,16 +999,13 @@ class ProcessRawFile:
                     breaches[metric] = comps
             elif metric == 'area_normalised':
                 for result in results:
-                    sql = "SELECT component_id FROM sample_component WHERE component_name = " + "'" + str(
-                        result[0]) + "'"
-                    self.db.cursor.execute(sql)
-                    comp_id = self.db.cursor.fetchone()[0]
+                    comp_id = self.db.get_component_id(result[0])
 
                     # get all values per component per machine
                     sql = "SELECT m.value FROM measurement m, qc_run q WHERE m.metric_id = " + "'" + str(metric_id) + "'" + \
                           " AND m.run_id = q.run_id AND " + \
                           " q.experiment_id = '" + str(self.eid) + "'" +\
-                          " AND q.machine_id = " + str(self.mid[0]) + \
+                          " AND q.machine_id = " + str(self.mid) + \
                           " AND m.component_id = " + "'" + str(comp_id) + "'" + " AND m.value <> -100 " +\
                                                                               " ORDER BY m.value"
                     self.db.cursor.execute(sql)
@@ -1022,33 +1035,6 @@ class ProcessRawFile:
         return breaches
 
     # OTHER
-    def fwhm_to_seconds(self):
-        sql = "SELECT metric_id FROM metric WHERE metric_name = 'fwhm'"
-
-        try:
-            self.db.cursor.execute(sql)
-            fwhm_id = self.db.cursor.fetchone()[0]
-        except Exception as e:
-            logger.exception(e)
-
-        sql = "SELECT run_id FROM qc_run WHERE file_name = " + "'" + self.file_name + "'"
-
-        try:
-            self.db.cursor.execute(sql)
-            run_id = self.db.cursor.fetchone()[0]
-        except Exception as e:
-            logger.exception(e)
-
-        update_sql = "UPDATE measurement SET value = value*60 WHERE run_id = " + "'" + str(run_id) + "'" + \
-                    " AND metric_id = " + "'" + str(fwhm_id) + "'"
-
-
-        try:
-            self.db.cursor.execute(update_sql)
-            self.db.db.commit()
-        except Exception as e:
-            logger.exception(e)
-
     def get_run_date_time(self):
     
         try:
@@ -1064,22 +1050,775 @@ class ProcessRawFile:
     
 
     def delete_files(self):
+        # removes or compresses the intermediate files once the run and chromatograms are inserted
+        # keeps what a replay needs (see Retention)
+        freed = Retention(self.retention).apply(self.outfiles_dir, self.file_name)
+        if freed:
+            logger.info("Freed " + "{:.1f}".format(freed / 1048576) + " MB for " + self.file_name)
+
+
+def csv_value(text):
+    # MZmine csv value as Decimal, nulls and anything MySQL can't store put to 0
+    try:
+        value = Decimal(text)
+    except InvalidOperation:
+        return Decimal(0)
+    return value if value.is_finite() else Decimal(0)
+
+
+def process_mzmine_batch(qc_runs):
+    # runs MZmine once for several converted runs to save the JVM start up and module loading per file
+    # the saved project of the batch is split into a <file>.mzmine per run
+    # returns the runs that were processed
+    if len(qc_runs) == 1:
+        return qc_runs if qc_runs[0].process_mzmine() else []
+
+    first = qc_runs[0]
+    machine_dir = os.path.dirname(first.outfiles_dir)
+    batch_name = "MZmine-batch-" + platform.node() + "-" + str(os.getpid()) + "-" + str(int(time.time() * 1000))
+    batch_xml = os.path.join(machine_dir, batch_name + ".xml")
+    batch_project = os.path.join(machine_dir, batch_name + ".mzmine")
+
+    batch = et.Element("batch")
+    project_step = None
+    for qc_run in qc_runs:
+        steps, project_step = qc_run.get_mzmine_steps()
+        batch.extend(steps)
+    if project_step is not None:
+        project_step.find("parameter/current_file").text = batch_project
+        batch.append(project_step)
+    et.ElementTree(batch).write(batch_xml, encoding="UTF-8", xml_declaration=True)
+
+    # timeout covers every file in the batch
+    timeout = first.tools.timeouts.get("mzmine", 0) * len(qc_runs)
+    logger.info("mzMine: batch of " + str(len(qc_runs)) + " files")
+    start = first.timer.sample()
+    success = first.run_mzmine(batch_xml, timeout)
+    usage = first.timer.since(start)
+    for qc_run in qc_runs:
+        qc_run.timer.add("mzmine", usage, len(qc_runs))
+
+    processed = []
+    failed = []
+    for qc_run in qc_runs:
+        if success and qc_run.has_mzmine_output():
+            if os.path.isfile(batch_project):
+                split_mzmine_project(batch_project, qc_run)
+            processed.append(qc_run)
+        else:
+            failed.append(qc_run)
+
+    for path in [batch_xml, batch_project]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    # one bad file fails the whole batch, so give the rest their own run
+    for qc_run in failed:
+        if qc_run.process_mzmine():
+            processed.append(qc_run)
+
+    return processed
+
+
+def split_mzmine_project(batch_project, qc_run):
+    # <file>.mzmine with the raw data and peak lists of this run only, entries of the batch project
+    # are named after the mzML files eg. "Raw data file #1 <file>_pos.mzML", other entries are copied
+    project = os.path.join(qc_run.outfiles_dir, qc_run.file_name + ".mzmine")
+    with zipfile.ZipFile(batch_project, "r") as source, \
+            zipfile.ZipFile(project, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as target:
+        for info in source.infolist():
+            per_run = info.filename.startswith("Raw data file #") or info.filename.startswith("Peak list #")
+            if per_run and " " + qc_run.file_name + "_" not in info.filename:
+                continue
+            with source.open(info) as f, target.open(info.filename, "w", force_zip64=True) as out:
+                shutil.copyfileobj(f, out)
+
+
+def search_morpheus_batch(qc_runs):
+    # searches several runs with one Morpheus run so CUSTOM.fasta is read and digested once
+    # returns the runs that were searched
+    if len(qc_runs) == 1 or qc_runs[0].experiment != "PROTEOMICS":
+        return [qc_run for qc_run in qc_runs if qc_run.search()]
+
+    first = qc_runs[0]
+    batch_dir = os.path.join(os.path.dirname(first.outfiles_dir),
+                             "Morpheus-batch-" + platform.node() + "-" + str(os.getpid()) + "-" + str(int(time.time() * 1000)))
+
+    # timeout covers every file in the batch
+    timeout = first.tools.timeouts.get("morpheus", 0) * len(qc_runs)
+    logger.info("Morpheus: batch of " + str(len(qc_runs)) + " files")
+    start = first.timer.sample()
+    success = first.run_morpheus([qc_run.pos_file for qc_run in qc_runs], batch_dir, timeout)
+    usage = first.timer.since(start)
+    for qc_run in qc_runs:
+        qc_run.timer.add("morpheus", usage, len(qc_runs))
+
+    header = ""
+    rows = []
+    summary = os.path.join(batch_dir, "summary.tsv")
+    if success and os.path.isfile(summary):
+        with open(summary, "r") as infile:
+            lines = infile.readlines()
+        header = lines[0]
+        rows = lines[1:]
+
+    searched = []
+    failed = []
+    for qc_run in qc_runs:
+        if header and qc_run.collect_morpheus_output(batch_dir, header, rows):
+            searched.append(qc_run)
+        else:
+            failed.append(qc_run)
+
+    shutil.rmtree(batch_dir, ignore_errors=True)
+
+    # one bad file fails the whole batch, so give the rest their own run
+    for qc_run in failed:
+        if qc_run.search():
+            searched.append(qc_run)
+
+    return searched
+
+
+def in_batches(items, size):
+    # splits a list into lists of up to size items
+    for i in range(0, len(items), max(1, size)):
+        yield items[i:i + max(1, size)]
 
-        # ADD: removal of .scans from chromatograms
+
+def update_stats(experiment_type, db, machine, machine_type, fs):
+    # stats and normalised metrics, pandas and numpy are only imported when they are updated
+    import MPMF_Stats
+    if thresholds_lock is not None:
+        MPMF_Stats.thresholds_lock = thresholds_lock
+    MPMF_Stats.Stat(experiment_type, db, machine, machine_type, fs).run()
+
+
+def thermo_metrics(raw_file, file_name, experiment_type, db, fs, machine):
+    # instrument metrics, the Thermo assemblies are only loaded for thermo machines
+    from MPMF_Thermo_Metrics import ThermoMetrics
+    ThermoMetrics(raw_file, file_name, experiment_type, db, fs, machine)
+
+
+def init_worker(log_queue, lock):
+    # share the thresholds lock so stats for different machines don't overwrite each other
+    global thresholds_lock
+    thresholds_lock = lock
+
+    # send worker log records to the parent so there is one consolidated log
+    for name in ['processing', 'MPMF_Database_SetUp']:
+        worker_logger = logging.getLogger(name)
+        for handler in list(worker_logger.handlers):
+            worker_logger.removeHandler(handler)
+        worker_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        worker_logger.setLevel(logging.DEBUG)
+
+    # forked workers start with a copy of the parent's metrics, only their own are sent back
+    registry.drain()
+
+
+def lower_priority(nice):
+    # runs this process and the tools it starts below live processing
+    if hasattr(os, "getpriority"):
         try:
-            os.remove(os.path.join(self.outfiles_dir, self.file_name + ".xml"))
-            os.remove(os.path.join(self.outfiles_dir, self.file_name + "_pos.mzXML"))
-            if self.experiment == 'METABOLOMICS':
-                os.remove(os.path.join(self.outfiles_dir, self.file_name + "_neg.mzXML"))
-        except Exception as e:
-            logger.exception(e)
+            # set rather than add, worker processes can backfill more than one machine
+            if os.getpriority(os.PRIO_PROCESS, 0) < nice:
+                os.setpriority(os.PRIO_PROCESS, 0, nice)
+        except OSError as e:
+            logger.warning("Unable to lower process priority: " + str(e))
+    elif os.name == 'nt' and nice > 0:
+        import ctypes
+        below_normal_priority_class = 0x4000
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), below_normal_priority_class)
+
+
+class LogForwarder(logging.Handler):
+    """
+        Passes records received from worker processes
+        to the matching logger in the parent process
+    """
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def read_settings():
+    # pipeline settings, defaults for anything not in the config file
+    settings = dict(DEFAULT_SETTINGS)
+    settings_file = os.path.join(os.getcwd(), "Config", "pipeline-settings.json")
+    if os.path.exists(settings_file):
+        with open(settings_file, "r") as f:
+            settings.update(json.load(f))
+    return settings
+
+
+def run_pipeline(jobs, machine, machine_type, experiment_type, fs, db_info, email, settings):
+    # runs the claimed jobs through msconvert, mzmine, morpheus and ingest stages at the same time
+    # each file has its own ProcessRawFile (and db connection) while it moves through the stages
+    stage_workers = settings["Pipeline Workers"]
+    job_ids = {}  # raw file -> job id
+    skipped = set()  # raw files not processed by convert, their jobs are done
+
+    def claimed():
+        # claims the next job when the first stage has room
+        job = jobs.claim(machine)
+        while job is not None:
+            job_ids[job[1]] = job[0]
+            yield job
+            job = jobs.claim(machine)
+
+    def convert(job):
+        _, raw_file, file_format = job
+        file_id = os.path.basename(raw_file)[:-len(file_format)]
+        qc_run = ProcessRawFile(file_id, raw_file, machine, experiment_type, fs, db_info, email, machine_type, file_format,
+                                settings)
+        try:
+            converted = qc_run.convert()
+        except Exception:
+            qc_run.close()
+            raise
+        if converted:
+            return qc_run
+        qc_run.close()
+        if qc_run.skipped:
+            skipped.add(raw_file)
+            jobs.complete(job_ids[raw_file])
+        return None
+
+    def mzmine(qc_runs):
+        return process_mzmine_batch(qc_runs)
+
+    def morpheus(qc_runs):
+        return search_morpheus_batch(qc_runs)
+
+    def ingest(qc_run):
+        if not qc_run.ingest():
+            return None
+
+        # only do thermo metrics, pressure and chroms if successful metric (mzmine/morpheus) insert
+        if machine_type == "thermo":
+            with qc_run.timer.stage("thermo"):
+                thermo_metrics(qc_run.raw_file, qc_run.file_name, experiment_type, qc_run.db, fs, machine)
+        with qc_run.timer.stage("chromatogram"):
+            Chromatogram(qc_run.file_name, fs, experiment_type, machine, qc_run.db)
+        qc_run.delete_files()
+        qc_run.timer.save(qc_run.db, qc_run.file_name)
+        qc_run.close()
+        jobs.complete(job_ids[qc_run.raw_file])
+        return qc_run
+
+    def discard(item):
+        if isinstance(item, ProcessRawFile):
+            item.close()
+            jobs.fail(job_ids[item.raw_file])
+        elif item[1] not in skipped:
+            jobs.fail(item[0])
+
+    scheduler = StageScheduler(settings["Pipeline Queue Size"], discard)
+    scheduler.add_stage("msconvert", convert, stage_workers.get("msconvert", 1))
+    scheduler.add_stage("mzmine", mzmine, stage_workers.get("mzmine", 1), settings["MZmine Batch Size"])
+    if experiment_type == "PROTEOMICS":
+        scheduler.add_stage("morpheus", morpheus, stage_workers.get("morpheus", 1), settings["Morpheus Batch Size"])
+    scheduler.add_stage("ingest", ingest, stage_workers.get("ingest", 1))
+
+    return len(scheduler.run(claimed()))
+
+
+def process_jobs(jobs, machine, machine_type, experiment_type, fs, db, db_info, email, settings, throttle=None,
+                 limit=0, stager=None):
+    # processes the claimed jobs for a machine one after the other (newest first), returns number inserted
+    # with MZmine and Morpheus batch sizes, jobs are converted first and then run through MZmine
+    # and Morpheus in batches
+    # with a throttle, the usage of each run is recorded and claims wait while over budget
+    # limit stops after that many jobs, 0 for all
+    # with a stager, the tools work on local copies and the next files are copied while a batch is processed
+    inserted = 0
+    total = 0
+    batch_size = max(1, settings["MZmine Batch Size"], settings["Morpheus Batch Size"])
+    if limit:
+        batch_size = min(batch_size, limit)
+    while not limit or total < limit:
+        if throttle:
+            throttle.wait()
+        job_ids = {}  # ProcessRawFile -> job id
+        raw_paths = {}  # ProcessRawFile -> raw file on the share
+        converted = []
+        claimed = 0
+        while claimed < batch_size and (not limit or total + claimed < limit):
+            job = jobs.claim(machine)
+            if job is None:
+                break
+            claimed += 1
+            job_id, raw_file, file_format = job
+
+            # get file name
+            file_id = os.path.basename(raw_file)[:-len(file_format)]
+
+            qc_run = None
+            error = "processing error"
+            try:
+                if stager:
+                    qc_run = ProcessRawFile(file_id, stager.get(raw_file), machine, experiment_type,
+                                            stager.file_system(fs, machine, experiment_type), db_info, email,
+                                            machine_type, file_format, settings)
+                else:
+                    qc_run = ProcessRawFile(file_id, raw_file, machine, experiment_type, fs, db_info, email,
+                                            machine_type, file_format, settings)
+                raw_paths[qc_run] = raw_file
+                if qc_run.convert():
+                    job_ids[qc_run] = job_id
+                    converted.append(qc_run)
+                    continue
+            except (Exception, SystemExit) as e:
+                logger.error("Processing failed for " + raw_file)
+                logger.exception(e)
+                error = str(e)
+
+            if qc_run is not None:
+                qc_run.close()
+                if throttle:
+                    throttle.record(*qc_run.timer.totals())
+                if stager:
+                    stager.publish(qc_run.outfiles_dir)
+            if stager:
+                stager.release(raw_file)
+            if qc_run is not None and qc_run.skipped:
+                # not a QC file or already inserted, nothing to retry
+                jobs.complete(job_id)
+            else:
+                jobs.fail(job_id, error)
+
+        if claimed == 0:
+            break
+        total += claimed
+
+        if stager:
+            # copies of the next files while this batch is in the tools
+            stager.prefetch(jobs.peek(machine, settings["Prefetch Files"]))
+
+        processed = []
+        for batch in in_batches(converted, settings["MZmine Batch Size"]):
+            try:
+                processed.extend(process_mzmine_batch(batch))
+            except (Exception, SystemExit) as e:
+                logger.exception(e)
+
+        searched = []
+        for batch in in_batches(processed, settings["Morpheus Batch Size"]):
+            try:
+                searched.extend(search_morpheus_batch(batch))
+            except (Exception, SystemExit) as e:
+                logger.exception(e)
+
+        for qc_run in converted:
+            job_id = job_ids[qc_run]
+            try:
+                # insert mzmine and morpheus metrics
+                try:
+                    ingested = qc_run in searched and qc_run.ingest()
+                finally:
+                    qc_run.close()
+
+                # only do thermo metrics, pressure and chroms if successful metric (mzmine/morpheus) insert
+                if ingested:
+                    # process instrument metrics for thermo machines
+                    if machine_type == "thermo":
+                        with qc_run.timer.stage("thermo"):
+                            thermo_metrics(qc_run.raw_file, qc_run.file_name, experiment_type, db, qc_run.fs, machine)
+
+                    # extract and add chromatogram data
+                    with qc_run.timer.stage("chromatogram"):
+                        Chromatogram(qc_run.file_name, qc_run.fs, experiment_type, machine, db)
+                    qc_run.delete_files()
+                    qc_run.timer.save(db, qc_run.file_name)
+                    jobs.complete(job_id)
+                    inserted += 1
+                else:
+                    jobs.fail(job_id)
+            except (Exception, SystemExit) as e:
+                logger.error("Processing failed for " + qc_run.raw_file)
+                logger.exception(e)
+                jobs.fail(job_id, str(e))
+
+            if throttle:
+                throttle.record(*qc_run.timer.totals())
+            if stager:
+                stager.publish(qc_run.outfiles_dir)
+                stager.release(raw_paths[qc_run])
+
+    return inserted
+
+
+def process_machine(machine, raw_files, machine_type, file_format, experiment_type, depth, email, in_dir, out_dir, db_info,
+                    pipeline=False, settings=None, newest_only=False, stale_stats=False):
+    # queues and processes the raw files for one machine then updates the stats
+    # runs in the main process or in a worker process (own db connection)
+    # newest_only processes just the newest file and leaves the stats to a later call with stale_stats
+    logger.info("Machine: " + machine)
+    logger.info("Found " + str(len(raw_files)) + " files")
+    fs = FileSystem(in_dir, out_dir, machine, experiment_type)  # used in processing and chrom and stats
+    pool = get_pool(db_info, settings["Database Pool Size"])
+    db = pool.checkout(fs)
+
+    # only one process per machine and experiment
+    jobs = JobQueue(db, experiment_type, settings)
+    if not jobs.acquire_machine_lock(machine):
+        logger.info("Processing already running for {} {}".format(machine, experiment_type))
+        pool.checkin(db)
+        return 0
+
+    heartbeat = Heartbeat(jobs, db_info)
+    heartbeat.start()
+    stager = create_stager(settings, out_dir)
+
+    try:
+        # set loop variable
+        if depth == -1:
+            loop = len(raw_files)
+        elif depth > len(raw_files):
+            loop = len(raw_files)
+        else:
+            loop = depth
+
+        # queue the new files among the most recent, failed files are retried by the queue
+        jobs.catalog(machine, raw_files, file_format, loop)
+
+        if newest_only:
+            # so the alert for the newest run isn't held up by the backlog of other machines
+            inserted = process_jobs(jobs, machine, machine_type, experiment_type, fs, db, db_info, email, settings,
+                                    limit=1, stager=stager)
+        elif pipeline:
+            # stages overlap between files
+            inserted = run_pipeline(jobs, machine, machine_type, experiment_type, fs, db_info, email, settings)
+        else:
+            inserted = process_jobs(jobs, machine, machine_type, experiment_type, fs, db, db_info, email, settings,
+                                    stager=stager)
+
+        # update stats and normalised metrics when runs were added, here or by processing nodes
+        if not newest_only and (jobs.take_stale(machine) or inserted or stale_stats):
+            update_stats(experiment_type, db, machine.strip(), machine_type, fs)
+    finally:
+        heartbeat.stop()
+        jobs.release_machine_lock(machine)
+        if stager:
+            stager.close()
+
+        # close database connection and cursor
+        pool.checkin(db)
+
+    return inserted
+
+
+def replay_machine(machine, raw_files, machine_type, file_format, experiment_type, depth, in_dir, out_dir, db_info,
+                   settings):
+    # inserts the runs of a machine again from OutFiles (eg. after a database rebuild), returns number inserted
+    # the tools are not run, only thermo metrics need the raw file
+    fs = FileSystem(in_dir, out_dir, machine, experiment_type)
+    pool = get_pool(db_info, settings["Database Pool Size"])
+    db = pool.checkout(fs)
+
+    jobs = JobQueue(db, experiment_type, settings)
+    if not jobs.acquire_machine_lock(machine):
+        logger.info("Processing already running for {} {}".format(machine, experiment_type))
+        pool.checkin(db)
+        return 0
+
+    heartbeat = Heartbeat(jobs, db_info)
+    heartbeat.start()
+
+    try:
+        # run folders, newest first
+        prefix = "QC_Metabolomics_" if experiment_type == "METABOLOMICS" else "QC_Proteomics_"
+        machine_dir = os.path.join(out_dir, experiment_type, machine)
+        run_names = []
+        if os.path.isdir(machine_dir):
+            with os.scandir(machine_dir) as entries:
+                run_names = [entry.name for entry in entries if entry.is_dir() and entry.name.startswith(prefix)]
+        run_names.sort(reverse=True)
+        if depth != -1:
+            run_names = run_names[:depth]
+        logger.info("Replaying " + str(len(run_names)) + " runs for " + machine)
+
+        raw_paths = {}
+        for entry in raw_files:
+            raw_paths[FileCatalog.file_name(entry, file_format)] = entry[0]
+
+        def replay_run(file_name):
+            raw_file = raw_paths.get(file_name)
+            qc_run = ProcessRawFile(file_name, raw_file or os.path.join(machine_dir, file_name), machine, experiment_type,
+                                    fs, db_info, False, machine_type, file_format, settings)
+            try:
+                if not qc_run.replay():
+                    return 0
+
+                if machine_type == "thermo" and raw_file:
+                    with qc_run.timer.stage("thermo"):
+                        thermo_metrics(raw_file, file_name, experiment_type, qc_run.db, fs, machine)
+                if os.path.isfile(os.path.join(qc_run.outfiles_dir, file_name + ".mzmine")):
+                    with qc_run.timer.stage("chromatogram"):
+                        Chromatogram(file_name, fs, experiment_type, machine, qc_run.db)
+                qc_run.delete_files()
+                qc_run.timer.save(qc_run.db, file_name)
+                return 1
+            except (Exception, SystemExit) as e:
+                logger.error("Replay failed for " + file_name)
+                logger.exception(e)
+                return 0
+            finally:
+                qc_run.close()
+
+        # inserts are mostly waiting on the database, so runs are replayed in threads
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, settings["Replay Threads"])) as executor:
+            inserted = sum(executor.map(replay_run, run_names))
+
+        # update stats and normalised metrics
+        if inserted:
+            update_stats(experiment_type, db, machine.strip(), machine_type, fs)
+    finally:
+        heartbeat.stop()
+        jobs.release_machine_lock(machine)
+        pool.checkin(db)
+
+    return inserted
+
+
+def backfill_machine(machine, raw_files, machine_type, file_format, experiment_type, in_dir, out_dir, db_info, settings):
+    # processes every raw file of a machine (eg. years of QC files of a new instrument), returns number inserted
+    # files are queued at backfill priority and processed by several workers at a lower process priority
+    # and within the CPU/IO budget, so live processing of the machine carries on
+    lower_priority(settings["Backfill Nice"])
+    logger.info("Backfilling " + str(len(raw_files)) + " files for " + machine)
+    fs = FileSystem(in_dir, out_dir, machine, experiment_type)
+    pool = get_pool(db_info, settings["Database Pool Size"])
+    db = pool.checkout(fs)
+
+    # no machine lock while processing, jobs are claimed one at a time so live processing takes the new files
+    jobs = JobQueue(db, experiment_type, settings, priority=1)
+    heartbeat = Heartbeat(jobs, db_info)
+    heartbeat.start()
+    throttle = Throttle(settings["Backfill CPU Budget"], settings["Backfill IO Budget"])
+    stager = create_stager(settings, out_dir)
+
+    def backfill_worker(_):
+        # each worker has its own connection for the thermo and chromatogram inserts
+        with pool.connection(fs) as worker_db:
+            return process_jobs(jobs, machine, machine_type, experiment_type, fs, worker_db, db_info, False, settings,
+                                throttle, stager=stager)
+
+    try:
+        jobs.catalog(machine, raw_files, file_format, len(raw_files))
+
+        workers = max(1, settings["Backfill Workers"])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            inserted = sum(executor.map(backfill_worker, range(workers)))
+
+        # stats and normalised metrics once for the whole backfill, under the machine lock so they are
+        # not updated by live processing at the same time, otherwise left to the process holding the lock
+        if inserted:
+            jobs.mark_stale(machine)
+            if jobs.acquire_machine_lock(machine):
+                try:
+                    if jobs.take_stale(machine):
+                        update_stats(experiment_type, db, machine.strip(), machine_type, fs)
+                finally:
+                    jobs.release_machine_lock(machine)
+            else:
+                logger.info("Stats for " + machine + " are left to the process holding its lock")
+    finally:
+        heartbeat.stop()
+        if stager:
+            stager.close()
+        pool.checkin(db)
+
+    return inserted
+
+
+def backfill_machine_worker(*args):
+    inserted = backfill_machine(*args)
+    return inserted, registry.drain()
+
+
+def run_machines(run_machine, run_machine_worker, tasks, workers):
+    # runs run_machine(machine, *tasks[machine]) for each machine, in worker processes with workers > 1
+    # returns ({machine: inserted}, exit status)
+    results = {}
+    exit_status = 0
+    if workers > 1 and len(tasks) > 1:
+        # one worker process per machine, records are logged by this process
+        log_queue = multiprocessing.Queue()
+        log_listener = logging.handlers.QueueListener(log_queue, LogForwarder())
+        log_listener.start()
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(tasks)),
+                                                    initializer=init_worker, initargs=(log_queue, multiprocessing.Lock())) as executor:
+            futures = {}
+            for machine in tasks:
+                future = executor.submit(run_machine_worker, machine, *tasks[machine])
+                futures[future] = machine
+
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    inserted, worker_metrics = future.result()
+                    registry.merge(worker_metrics)
+                    results[futures[future]] = inserted
+                    logger.info("Finished " + futures[future] + ", inserted " + str(inserted) + " files")
+                except BaseException as e:
+                    logger.error("Processing failed for " + futures[future])
+                    logger.exception(e)
+                    exit_status = 1
+
+        log_listener.stop()
+    else:
+        for machine in tasks:
+            try:
+                results[machine] = run_machine(machine, *tasks[machine])
+            except Exception as e:
+                logger.error("Processing failed for " + machine)
+                logger.exception(e)
+                exit_status = 1
+
+    return results, exit_status
+
+
+def replay_machine_worker(*args):
+    inserted = replay_machine(*args)
+    return inserted, registry.drain()
+
+
+def process_machine_worker(*args):
+    # process_machine in a worker process, returns (inserted, metrics) as the metrics stay in the worker
+    inserted = process_machine(*args)
+    return inserted, registry.drain()
+
+
+def create_watcher(machine_names, file_formats, experiment_type, in_dir, settings):
+    # created before the folders are scanned at startup, so files arriving during the first pass are not missed
+    folders = {}
+    for machine in machine_names:
+        folders[machine[0]] = os.path.join(in_dir, machine[0])
+    prefix = "QC_Metabolomics_" if experiment_type == "METABOLOMICS" else "QC_Proteomics_"
+    return RawFileWatcher(folders, prefix, file_formats, settings["Watch Interval"], settings["Watch Poll"])
+
+
+def watch_machines(watcher, machine_names, experiment_type, email, in_dir, out_dir, db_info, settings, exporter):
+    # daemon mode, processes new QC files as soon as the instrument has closed them
+    # keeps the db connection and libraries loaded between files
+    folders = watcher.folders
+    machine_types = {}
+    file_systems = {}
+    for machine in machine_names:
+        machine_types[machine[0]] = machine[1]
+        file_systems[machine[0]] = FileSystem(in_dir, out_dir, machine[0], experiment_type)
+
+    pool = get_pool(db_info, settings["Database Pool Size"])
+    db = pool.checkout()
+    jobs = JobQueue(db, experiment_type, settings)
+    heartbeat = Heartbeat(jobs, db_info)
+    heartbeat.start()
+    logger.info("Watching for new {} files".format(experiment_type))
+
+    # one batch per machine in each round, newest first, so a new file doesn't wait for a backlog
+    limit = max(1, settings["MZmine Batch Size"], settings["Morpheus Batch Size"])
+    stale_stats = set()  # machines with runs inserted since their stats were updated
+    busy = False
+    stager = create_stager(settings, out_dir)
+    try:
+        while True:
+            db.check()  # connection may have timed out while idle
+            config.refresh()  # thresholds and reference files edited while watching
+            # no waiting for new files while there is a backlog
+            for machine, raw_file, file_format in watcher.wait(block=not busy):
+                logger.info("New file for " + machine + ": " + raw_file)
+                try:
+                    jobs.enqueue(machine, [FileCatalog.file_entry(raw_file)], file_format)
+                except OSError as e:
+                    # renamed or removed since the event
+                    logger.warning("Unable to queue " + raw_file + ": " + str(e))
+
+            # new files and retries that are due, skipping machines locked by other processes
+            busy = False
+            for machine in folders:
+                if jobs.acquire_machine_lock(machine):
+                    fs = file_systems[machine]
+                    if process_jobs(jobs, machine, machine_types[machine], experiment_type, fs, db, db_info, email, settings,
+                                    limit=limit, stager=stager):
+                        stale_stats.add(machine)
+                    if jobs.ready(machine):
+                        busy = True
+                    elif jobs.take_stale(machine) or machine in stale_stats:
+                        # stats once the backlog of the machine is done, including runs of processing nodes
+                        stale_stats.discard(machine)
+                        try:
+                            update_stats(experiment_type, db, machine, machine_types[machine], fs)
+                        except Exception as e:
+                            # the other machines keep being watched, the stats are updated with the next run
+                            logger.exception(e)
+            exporter.write()
+    finally:
+        heartbeat.stop()
+        for machine in folders:
+            jobs.release_machine_lock(machine)
+        watcher.close()
+        if stager:
+            stager.close()
+        pool.checkin(db)
+
+
+def run_node(machine_names, experiment_type, email, in_dir, out_dir, db_info, settings):
+    # processing node, claims queued files of every machine from the shared database until stopped
+    # files are queued by the process that scans the machine folders (normal or --watch processing)
+    # nodes don't take the machine lock and never update the stats, they only mark them stale for the host
+    # that scans the folders, Stat writes the ms2 thresholds to the Config folder the server reads
+    machine_types = {}
+    file_systems = {}
+    for machine in machine_names:
+        machine_types[machine[0]] = machine[1]
+        file_systems[machine[0]] = FileSystem(in_dir, out_dir, machine[0], experiment_type)
+
+    pool = get_pool(db_info, settings["Database Pool Size"])
+    db = pool.checkout()
+    jobs = JobQueue(db, experiment_type, settings, in_dir=in_dir)
+    heartbeat = Heartbeat(jobs, db_info)
+    heartbeat.start()
+    logger.info("Processing node {} for {} files".format(jobs.owner, experiment_type))
+
+    # one batch per machine in each round so every machine is served
+    limit = max(1, settings["MZmine Batch Size"], settings["Morpheus Batch Size"])
+    stager = create_stager(settings, out_dir)
+    try:
+        while True:
+            db.check()
+            config.refresh()
+            busy = False
+            for machine in machine_types:
+                fs = file_systems[machine]
+                if process_jobs(jobs, machine, machine_types[machine], experiment_type, fs, db, db_info, email, settings,
+                                limit=limit, stager=stager):
+                    jobs.mark_stale(machine)
+                if jobs.ready(machine):
+                    busy = True
+            if not busy:
+                time.sleep(settings["Watch Interval"])
+    finally:
+        heartbeat.stop()
+        if stager:
+            stager.close()
+        pool.checkin(db)
 
 
 if __name__ == "__main__":
+
+    init_logging()
    
     # Arguments: experiment (proteomics, metabolomics)
     #            depth (number of files to process, -1 equals all)
     #            email (Y N)
+    #            --workers (optional, number of machines processed at the same time)
+    #            --pipeline (optional, overlap the processing stages of consecutive files)
+    #            --watch (optional, keep running and process new files as they arrive)
+    #            --replay (optional, insert runs again from OutFiles without running the tools)
+    #            --backfill (optional, process all files at low priority alongside live processing)
+    #            --node (optional, process files queued by other hosts from the shared database until stopped)
     #
     
     # Machine data needs to be in_dir\experiment_type\machine_name
@@ -1092,30 +1831,43 @@ if __name__ == "__main__":
     db_info["user"] = db_details["User"]
     db_info["port"] = db_details["Database Port"]
     db_info["database"] = db_details["Database Name"]
+    db_info["host"] = db_details.get("Database Host", "localhost")
 
     with open(os.path.join(os.getcwd(), "Config", ".maspeqc_gen"), "r") as f:
         db_info["password"] = f.read()
 
     # set database details
-    db = MPMFDBSetUp(db_info["user"], db_info["password"], db_info["database"], "", db_info["port"])
+    db = get_pool(db_info).checkout()
 
     # get arguments
-    experiment_type = sys.argv[1].upper()
-    depth = int(sys.argv[2])
-    email = sys.argv[3].upper()
+    parser = argparse.ArgumentParser(description="Process QC raw files")
+    parser.add_argument("experiment", help="metabolomics or proteomics")
+    parser.add_argument("depth", type=int, help="number of most recent runs to process, -1 equals all")
+    parser.add_argument("email", help="Y or N for sending notification emails")
+    parser.add_argument("--workers", type=int, default=1, help="number of machines processed in parallel")
+    parser.add_argument("--pipeline", action="store_true", help="run msconvert, mzmine, morpheus and inserts as overlapping stages")
+    parser.add_argument("--watch", action="store_true", help="after processing keep running and process new files as they arrive")
+    parser.add_argument("--replay", action="store_true", help="insert runs again from OutFiles without running the tools, no emails")
+    parser.add_argument("--backfill", action="store_true", help="process all files at low priority alongside live processing, no emails")
+    parser.add_argument("--node", action="store_true", help="keep processing files queued in the shared database, depth is ignored")
+    args = parser.parse_args()
+    settings = read_settings()
+
+    experiment_type = args.experiment.upper()
+    depth = args.depth
+    email = args.email.upper()
     if email == "Y":
         email = True
     else:
         email = False
+    workers = max(1, args.workers)
 
-    # check if running
-    if os.path.exists(experiment_type + ".txt"):
-        logger.info("Script already running for {}".format(experiment_type))
-        sys.exit(1)
-    else:
-        with open(experiment_type + ".txt", "w") as f:
-            f.write("")
-        logger.info("Starting processing for {}. Number of runs = {}. Sending email = {}.".format(experiment_type, depth, email))
+    # machines are locked in the job queue, make sure the tables exist for older databases
+    db.create_table_processing_job()
+    db.create_table_machine_lock()
+    db.create_table_stage_timing()
+    db.create_table_stats_pending()
+    logger.info("Starting processing for {}. Number of runs = {}. Sending email = {}. Workers = {}.".format(experiment_type, depth, email, workers))
 
     # read in directories
     if experiment_type == "METABOLOMICS":
@@ -1155,80 +1907,87 @@ if __name__ == "__main__":
             logger.exception(e)
             run_check = False
 
-    # get raw files for each machine
+    if run_check and args.node:
+        # no folder scans, the files are queued by the host that processes normally or watches
+        get_pool(db_info).checkin(db)
+        try:
+            run_node(machine_names, experiment_type, email, in_dir, out_dir, db_info, settings)
+        except KeyboardInterrupt:
+            logger.info("Stopped processing node")
+        get_pool(db_info).close()
+        sys.exit(0)
+
+    # get raw files for each machine (path, size, mtime), newest first
     file_formats = ['.mzXML', '.mzML', '.raw', '.wiff', 'wiff2', '.d', '.yep', '.baf', '.fid', '.tdf', '.lcd',
                     '.RAW', '.WIFF', '.WIFF2', '.D', '.YEP', '.BAF', '.FID', '.TDF', '.LCD']
-    raw_files = []
     machines = {}
+    watcher = None
 
     if run_check:
-        if experiment_type == "METABOLOMICS":
-            for machine in machine_names:
-                for _format in file_formats:
-                    raw_files = glob.glob(os.path.join(in_dir, machine[0], 'QC_Metabolomics_*' + _format))
-                    if len(raw_files) > 0:
-                        raw_files.sort(key=lambda x: os.path.getmtime(x), reverse=True)
-                        machines[machine[0]] = [raw_files, machine[1]]
-                        ext_length = len(_format)
-                        file_format = _format
-                        break
-        elif experiment_type == "PROTEOMICS":
-            for machine in machine_names:
-                for _format in file_formats:
-                    raw_files = glob.glob(os.path.join(in_dir, machine[0], 'QC_Proteomics_*' + _format))
-                    if len(raw_files) > 0:
-                        raw_files.sort(key=lambda x: os.path.getmtime(x), reverse=True)
-                        machines[machine[0]] = [raw_files, machine[1]]
-                        ext_length = len(_format)
-                        file_format = _format
-                        break
-
+        if args.watch:
+            watcher = create_watcher(machine_names, file_formats, experiment_type, in_dir, settings)
+        prefix = "QC_Metabolomics_" if experiment_type == "METABOLOMICS" else "QC_Proteomics_"
+        catalog = FileCatalog(in_dir, prefix, file_formats)
+        for machine in machine_names:
+            file_format, raw_files = catalog.scan(machine[0])
+            # runs are replayed from OutFiles even when the raw files are gone
+            if len(raw_files) > 0 or args.replay:
+                machines[machine[0]] = [raw_files, machine[1], file_format]
+
+    # return the connection, each machine checks out its own
+    get_pool(db_info).checkin(db)
+
+    # replays and backfills can load the measurements, chromatograms and pressure profiles with LOAD DATA
+    bulk_db_info = dict(db_info, bulk=settings["Bulk Load"])
+
+    # arguments for each machine
+    tasks = {}
+    for machine in machines:
+        raw_files, machine_type, file_format = machines[machine]
+        if args.replay:
+            tasks[machine] = (raw_files, machine_type, file_format, experiment_type, depth, in_dir, out_dir, bulk_db_info,
+                              settings)
+        elif args.backfill:
+            tasks[machine] = (raw_files, machine_type, file_format, experiment_type, in_dir, out_dir, bulk_db_info,
+                              settings)
+        else:
+            tasks[machine] = (raw_files, machine_type, file_format, experiment_type, depth, email, in_dir, out_dir,
+                              db_info, args.pipeline, settings)
+    if args.replay:
+        run_machine, run_machine_worker = replay_machine, replay_machine_worker
+    elif args.backfill:
+        run_machine, run_machine_worker = backfill_machine, backfill_machine_worker
+    else:
+        run_machine, run_machine_worker = process_machine, process_machine_worker
 
     # loop through machines and process raw files
+    exit_status = 0
     if run_check:
-        for machine in machines:
-            logger.info("Machine: " + machine)
-            logger.info("Found " + str(len(machines[machine][0])) + " files")
-            fs = FileSystem(in_dir, out_dir, machine, experiment_type)  # used in processing and chrom and stats
-
-            # set loop variable
-            if depth == -1:
-                loop = len(machines[machine][0])
-            elif depth > len(machines[machine][0]):
-                loop = len(machines[machine][0])
-            else:
-                loop = depth
+        if not args.replay and not args.backfill and len(machines) > workers:
+            # machines wait for each other, so first the newest file of each machine for its alert, then the backlogs
+            newest, exit_status = run_machines(process_machine, process_machine_worker,
+                                               dict((machine, tasks[machine] + (True,)) for machine in machines), workers)
+            for machine in machines:
+                tasks[machine] = tasks[machine] + (False, newest.get(machine, 0) > 0)
 
-            # loop backwards
-            for k in range(loop-1, -1, -1):
+        _, status = run_machines(run_machine, run_machine_worker, tasks, workers)
+        exit_status = max(exit_status, status)
 
-                # get file name
-                _, tail = os.path.split(machines[machine][0][k])
-                file_id = tail[:-ext_length]
-
-                # process raw file for mzmine and morpheus metrics
-                qc_run = ProcessRawFile(file_id, machines[machine][0][k], machine, experiment_type, fs, db_info, email, machines[machine][1], file_format)
+        logger.info("FINISHED PROCESSING")
 
-                # only do thermo metrics, pressure and chroms if successful metric (mzmine/morpheus) insert
-                if qc_run.run():
-                    # process instrument metrics for thermo machines
-                    if machines[machine][1] == "thermo":
-                        ThermoMetrics(machines[machine][0][k], file_id, experiment_type, db, fs, machine)
+        # metrics file after every run, and a local endpoint while watching
+        exporter = MetricsExporter(db_info, experiment_type, settings["Metrics File"],
+                                   settings["Metrics Port"] if args.watch else 0)
+        exporter.write()
 
-                    # extract and add chromatogram data
-                    Chromatogram(file_id, fs, experiment_type, machine, db)
-            
-            # update stats and normalised metrics
-            new_stat = Stat(experiment_type, db, machine.strip(),  machines[machine][1], fs)
-            new_stat.run()
-            
-            
-
-        logger.info("FINISHED PROCESSING")
-        
-    # close database connection and cursor
-    db.cursor.close()
-    db.db.close()
-    
-    # remove runtime file
-    os.remove(experiment_type + ".txt")
+        if args.watch:
+            try:
+                watch_machines(watcher, machine_names, experiment_type, email, in_dir, out_dir, db_info, settings,
+                               exporter)
+            except KeyboardInterrupt:
+                logger.info("Stopped watching")
+        exporter.close()
+
+    get_pool(db_info).close()
+    get_pool(bulk_db_info).close()
+    sys.exit(exit_status)
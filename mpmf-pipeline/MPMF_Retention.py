@@ -0,0 +1,162 @@
+# MaSpeQC - Quality control software for LC-MS/MS instrumentation
+#
+# Copyright (C) 2018-2025  Simon Caven
+# Copyright (C) 2020-2025  Monash University
+# Copyright (C) 2022-2025  University of Applied Sciences Mittweida
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import logging
+from MPMF_Database_SetUp import MPMFDBSetUp
+logger = logging.getLogger('processing.retention')
+
+# what happens to each kind of file once a run is inserted: keep, compress or delete
+DEFAULT_POLICY = {"mzML": "compress", "Chromatogram Files": "delete", "Morpheus Files": "keep"}
+ACTIONS = ["keep", "compress", "delete"]
+
+
+class Retention:
+    """
+        Removes or compresses the large intermediate files of an inserted run in OutFiles
+        Kept: posoutput.csv/negoutput.csv, the .mzmine project, the MZmine batch file and the
+        Morpheus summary.tsv and PSMs.tsv, which is everything a replay needs
+        mzML: the converted files (the largest files of a run)
+        Chromatogram Files: Peak list/Raw data file files extracted from the .mzmine project (copies)
+        Morpheus Files: the other Morpheus output eg. pep.xml
+        Used by ProcessRawFile after a run is inserted and by the sweep command
+    """
+    def __init__(self, policy=None):
+        self.policy = dict(DEFAULT_POLICY)
+        self.policy.update(policy or {})
+        for kind in self.policy:
+            if self.policy[kind] not in ACTIONS:
+                logger.warning("Unknown retention " + str(self.policy[kind]) + " for " + kind + ", keeping files")
+                self.policy[kind] = "keep"
+
+    def files(self, outfiles_dir, file_name):
+        # [(path, kind)] of the files the policy applies to
+        files = []
+        try:
+            with os.scandir(outfiles_dir) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    if entry.name in [file_name + "_pos.mzML", file_name + "_neg.mzML"]:
+                        files.append((entry.path, "mzML"))
+                    elif entry.name.startswith("Peak list #") or entry.name.startswith("Raw data file #"):
+                        files.append((entry.path, "Chromatogram Files"))
+        except OSError:
+            return files
+
+        morph_out_dir = os.path.join(outfiles_dir, "Morpheus")
+        if os.path.isdir(morph_out_dir):
+            with os.scandir(morph_out_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name not in ["summary.tsv", file_name + "_pos.PSMs.tsv"] \
+                            and not entry.name.endswith(".gz"):
+                        files.append((entry.path, "Morpheus Files"))
+        return files
+
+    def apply(self, outfiles_dir, file_name, dry_run=False):
+        # returns the number of bytes freed
+        freed = 0
+        for path, kind in self.files(outfiles_dir, file_name):
+            action = self.policy.get(kind, "keep")
+            if action == "keep":
+                continue
+            try:
+                size = os.path.getsize(path)
+                if kind == "mzML" and (os.path.islink(path) or os.stat(path).st_nlink > 1):
+                    # linked to the input file, removing the link frees nothing and compressing would add a copy
+                    action = "delete"
+                    size = 0
+                if dry_run:
+                    logger.info("Would " + action + " " + path)
+                    freed += size
+                elif action == "delete":
+                    os.remove(path)
+                    freed += size
+                else:
+                    freed += size - compress(path)
+            except OSError as e:
+                logger.warning("Unable to " + action + " " + path + ": " + str(e))
+        return freed
+
+
+def compress(path):
+    # replaces the file with path.gz, returns the compressed size
+    with open(path, "rb") as infile:
+        with gzip.open(path + ".gz.tmp", "wb", compresslevel=6) as outfile:
+            shutil.copyfileobj(infile, outfile, 1024 * 1024)
+    os.replace(path + ".gz.tmp", path + ".gz")
+    os.remove(path)
+    return os.path.getsize(path + ".gz")
+
+
+def sweep(db, out_dir, experiment_type, policy=None, machine=None, dry_run=False):
+    # applies the policy to the runs in OutFiles that are in the database, returns bytes freed
+    retention = Retention(policy)
+    sql = "SELECT m.machine_name, q.file_name FROM qc_run q JOIN machine m ON m.machine_id = q.machine_id " \
+          "JOIN experiment e ON e.experiment_id = q.experiment_id WHERE e.experiment_type = %s"
+    params = [experiment_type.lower()]
+    if machine:
+        sql += " AND m.machine_name = %s"
+        params.append(machine)
+    db.cursor.execute(sql, params)
+
+    freed = 0
+    runs = 0
+    for machine_name, file_name in db.cursor.fetchall():
+        outfiles_dir = os.path.join(out_dir, experiment_type.upper(), machine_name, file_name)
+        if os.path.isdir(outfiles_dir):
+            freed += retention.apply(outfiles_dir, file_name, dry_run)
+            runs += 1
+    logger.info("Swept " + str(runs) + " runs, " + "{:.1f}".format(freed / 1048576) + " MB "
+                + ("to free" if dry_run else "freed"))
+    return freed
+
+
+if __name__ == "__main__":
+
+    # Arguments: experiment (proteomics, metabolomics)
+    #            --machine (optional, one machine only)
+    #            --dry-run (optional, only list the files)
+
+    parser = argparse.ArgumentParser(description="Apply the retention policy to the runs already in OutFiles")
+    parser.add_argument("experiment", help="metabolomics or proteomics")
+    parser.add_argument("--machine", help="sweep a single machine")
+    parser.add_argument("--dry-run", action="store_true", help="list the files without changing them")
+    args = parser.parse_args()
+
+    from MPMF_Process_Raw_Files import init_logging, read_settings
+    init_logging()
+    settings = read_settings()
+
+    with open(os.path.join(os.getcwd(), "Config", "database-login.json"), "r") as f:
+        db_details = json.load(f)
+    with open(os.path.join(os.getcwd(), "Config", ".maspeqc_gen"), "r") as f:
+        password = f.read()
+    with open(os.path.join(os.getcwd(), "Config", "dir-" + args.experiment.lower() + ".csv"), "r") as f:
+        out_dir = f.readline().strip().split("|")[1]
+
+    db = MPMFDBSetUp(db_details["User"], password, db_details["Database Name"], "", db_details["Database Port"],
+                     db_details.get("Database Host", "localhost"))
+    sweep(db, out_dir, args.experiment, settings["Retention"], args.machine, args.dry_run)
+    db.cursor.close()
+    db.db.close()
@@ -0,0 +1,161 @@
+# MaSpeQC - Quality control software for LC-MS/MS instrumentation
+#
+# Copyright (C) 2018-2025  Simon Caven
+# Copyright (C) 2020-2025  Monash University
+# Copyright (C) 2022-2025  University of Applied Sciences Mittweida
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import queue
+import threading
+import time
+import logging
+logger = logging.getLogger('processing.scheduler')
+
+# marks the end of the items for a stage worker
+_STOP = object()
+
+
+class StageScheduler:
+    """
+        Passes items through a sequence of stages
+        Each stage has its own worker threads and a bounded queue in front of it,
+        so file N+1 can be converted while file N is in mzmine
+        Used by MPMF_Process_Raw_Files in pipeline mode
+    """
+    def __init__(self, queue_size=2, discard=None):
+        self.queue_size = max(1, queue_size)
+        self.discard = discard  # called with items dropped by a stage
+        self.stages = []
+
+    def add_stage(self, name, function, workers=1, batch=1):
+        # function takes an item and returns it for the next stage, or None to drop it
+        # with batch > 1 function takes a list of up to batch waiting items and returns the list to pass on
+        self.stages.append({'name': name, 'function': function, 'workers': max(1, workers), 'batch': max(1, batch)})
+
+    def run(self, items):
+        # returns the items that made it through every stage
+        queues = [queue.Queue(maxsize=max(self.queue_size, stage['batch'])) for stage in self.stages]
+        results = []
+        results_lock = threading.Lock()
+
+        threads = []
+        for i in range(len(self.stages)):
+            stage_threads = []
+            for n in range(self.stages[i]['workers']):
+                thread = threading.Thread(target=self.stage_worker, args=(i, queues, results, results_lock),
+                                          name=self.stages[i]['name'] + "-" + str(n + 1), daemon=True)
+                thread.start()
+                stage_threads.append(thread)
+            threads.append(stage_threads)
+
+        # blocks when the first stage is full
+        for item in items:
+            queues[0].put(item)
+
+        # stop each stage once the stage before it has finished
+        for i in range(len(self.stages)):
+            for n in range(self.stages[i]['workers']):
+                queues[i].put(_STOP)
+            for thread in threads[i]:
+                thread.join()
+
+        return results
+
+    def stage_worker(self, index, queues, results, results_lock):
+        stage = self.stages[index]
+        stopped = False
+        while not stopped:
+            item = queues[index].get()
+            if item is _STOP:
+                break
+
+            # batch stages take whatever else is waiting, up to the batch size
+            items = [item]
+            while len(items) < stage['batch']:
+                try:
+                    item = queues[index].get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopped = True
+                    break
+                items.append(item)
+
+            try:
+                if stage['batch'] > 1:
+                    next_items = stage['function'](items) or []
+                    dropped = [item for item in items if item not in next_items]
+                else:
+                    next_items = [stage['function'](items[0])]
+                    dropped = items if next_items[0] is None else []
+            except (Exception, SystemExit) as e:  # SystemExit would silently end the thread
+                logger.error("Stage " + stage['name'] + " failed")
+                logger.exception(e)
+                next_items = []
+                dropped = items
+
+            if self.discard:
+                for item in dropped:
+                    try:
+                        self.discard(item)
+                    except Exception as e:
+                        logger.exception(e)
+
+            for next_item in next_items:
+                if next_item is None:
+                    continue
+                if index + 1 < len(self.stages):
+                    queues[index + 1].put(next_item)
+                else:
+                    with results_lock:
+                        results.append(next_item)
+
+
+class Throttle:
+    """
+        Keeps the CPU and I/O use of a backfill within a budget
+        Workers record the usage of each run and wait before claiming the next one
+        until the time since the start covers the usage at the budgeted rate
+        Used by MPMF_Process_Raw_Files in backfill mode
+    """
+    def __init__(self, cpu_budget=0, io_budget=0):
+        self.cpu_rate = cpu_budget / 100 * (os.cpu_count() or 1)  # % of all cores -> CPU seconds per second
+        self.io_rate = io_budget * 1048576  # MB/s -> bytes per second
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.cpu = 0.0
+        self.io = 0
+
+    def record(self, cpu, io):
+        with self.lock:
+            self.cpu += cpu
+            self.io += io
+
+    def delay(self):
+        # seconds until the usage so far is within the budget
+        with self.lock:
+            needed = 0
+            if self.cpu_rate > 0:
+                needed = max(needed, self.cpu / self.cpu_rate)
+            if self.io_rate > 0:
+                needed = max(needed, self.io / self.io_rate)
+            return max(0, needed - (time.monotonic() - self.start))
+
+    def wait(self):
+        delay = self.delay()
+        if delay > 0:
+            logger.info("Backfill over budget, waiting " + "{:.0f}".format(delay) + "s")
+            time.sleep(delay)
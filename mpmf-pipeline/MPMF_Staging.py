@@ -0,0 +1,180 @@
+# MaSpeQC - Quality control software for LC-MS/MS instrumentation
+#
+# Copyright (C) 2018-2025  Simon Caven
+# Copyright (C) 2020-2025  Monash University
+# Copyright (C) 2022-2025  University of Applied Sciences Mittweida
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import os
+import platform
+import shutil
+import threading
+import logging
+from MPMF_Catalog import file_signature
+from MPMF_File_System import FileSystem
+logger = logging.getLogger('processing.staging')
+
+# ioctl to share the blocks of a file on Linux (Btrfs, XFS)
+FICLONE = 0x40049409
+
+
+class Stager:
+    """
+        Local scratch space (SSD or tmpfs) for raw files on a network share
+        The next queued raw files are copied in the background while the current files are processed,
+        the tools read and write in a local OutFiles folder and finished runs are moved to the real one
+        Used by process_jobs in MPMF_Process_Raw_Files
+    """
+    def __init__(self, scratch_dir, out_dir, prefetch=2):
+        self.raw_dir = os.path.join(scratch_dir, "raw")
+        self.out_dir = os.path.join(scratch_dir, "OutFiles")
+        self.final_out_dir = out_dir
+        self.prefetch_count = prefetch
+        self.lock = threading.Lock()
+        self.copies = {}  # raw file -> {'local', 'signature', 'done'}
+        self.file_systems = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+
+    def file_system(self, fs, machine, experiment_type):
+        # FileSystem with the local OutFiles folder
+        key = (machine, experiment_type)
+        if key not in self.file_systems:
+            self.file_systems[key] = FileSystem(fs.in_dir, self.out_dir, machine, experiment_type)
+        return self.file_systems[key]
+
+    def prefetch(self, raw_files):
+        # starts copying raw files that are not local yet
+        for raw_file in raw_files[:self.prefetch_count]:
+            with self.lock:
+                if raw_file in self.copies:
+                    continue
+                entry = self.new_entry(raw_file)
+            self.executor.submit(self.copy, raw_file, entry)
+
+    def get(self, raw_file):
+        # returns the local copy, copied now if it wasn't prefetched or the file changed since
+        # falls back to the file on the share if it can't be copied
+        with self.lock:
+            entry = self.copies.get(raw_file)
+        if entry is not None:
+            entry['done'].wait()
+            if entry['signature'] is not None and entry['signature'] == file_signature(raw_file):
+                return entry['local']
+
+        with self.lock:
+            entry = self.new_entry(raw_file)
+        self.copy(raw_file, entry)
+        return entry['local'] if entry['signature'] is not None else raw_file
+
+    def new_entry(self, raw_file):
+        # machine folder and file name, QC file names can repeat between machines
+        local = os.path.join(self.raw_dir, os.path.basename(os.path.dirname(raw_file)), os.path.basename(raw_file))
+        entry = {'local': local, 'signature': None, 'done': threading.Event()}
+        self.copies[raw_file] = entry
+        return entry
+
+    def copy(self, raw_file, entry):
+        # copies to a temporary name first so a partial copy is never used
+        partial = entry['local'] + ".part"
+        try:
+            signature = file_signature(raw_file)
+            os.makedirs(os.path.dirname(entry['local']), exist_ok=True)
+            remove(partial)
+            remove(entry['local'])
+            if os.path.isdir(raw_file):
+                shutil.copytree(raw_file, partial)
+            else:
+                shutil.copy2(raw_file, partial)
+            os.replace(partial, entry['local'])
+            entry['signature'] = signature
+            logger.debug("Staged " + raw_file)
+        except OSError as e:
+            logger.warning("Unable to stage " + raw_file + ": " + str(e))
+            remove(partial)
+        finally:
+            entry['done'].set()
+
+    def release(self, raw_file):
+        # removes the local copy once the file is processed
+        with self.lock:
+            entry = self.copies.pop(raw_file, None)
+        if entry is not None:
+            entry['done'].wait()
+            remove(entry['local'])
+
+    def publish(self, outfiles_dir):
+        # moves the local output folder of a run to the OutFiles folder
+        if not os.path.isdir(outfiles_dir):
+            return
+        final_dir = os.path.join(self.final_out_dir, os.path.relpath(outfiles_dir, self.out_dir))
+        try:
+            if os.path.isdir(final_dir):
+                # reprocessed run, newer files replace the old ones
+                shutil.copytree(outfiles_dir, final_dir, dirs_exist_ok=True)
+                shutil.rmtree(outfiles_dir)
+            else:
+                os.makedirs(os.path.dirname(final_dir), exist_ok=True)
+                shutil.move(outfiles_dir, final_dir)
+        except OSError as e:
+            logger.error("Unable to move " + outfiles_dir + " to " + final_dir + ": " + str(e))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            raw_files = list(self.copies)
+        for raw_file in raw_files:
+            self.release(raw_file)
+
+
+def remove(path):
+    # removes a file or folder if it exists
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def link_file(source, dest):
+    # makes dest a hardlink, reflink or symlink of source, a copy if none of them are possible
+    # returns how it was done
+    remove(dest)
+    try:
+        os.link(source, dest)
+        return "hardlink"
+    except OSError:
+        pass
+    if platform.system() == 'Linux':
+        try:
+            import fcntl
+            with open(source, "rb") as infile, open(dest, "wb") as outfile:
+                fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            return "reflink"
+        except OSError:
+            remove(dest)
+    try:
+        os.symlink(os.path.abspath(source), dest)  # needs developer mode or admin rights on Windows
+        return "symlink"
+    except (OSError, NotImplementedError):
+        pass
+    shutil.copy(source, dest)
+    return "copy"
+
+
+def create_stager(settings, out_dir):
+    # Stager when "Scratch Dir" is set, None to process on the shares
+    if not settings["Scratch Dir"]:
+        return None
+    return Stager(settings["Scratch Dir"], out_dir, settings["Prefetch Files"])
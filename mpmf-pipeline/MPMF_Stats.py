@@ -19,11 +19,18 @@
 
 import json
 import os
+import threading
+import time
 import numpy as np
 import pandas as pd
 import logging
+from MPMF_Config import read_thresholds
+from MPMF_Metrics import registry
 logger = logging.getLogger('processing.stats')
 
+# guards the shared ms2 thresholds json, replaced by a process lock in worker processes
+thresholds_lock = threading.Lock()
+
 
 class Stat:
     """
@@ -42,6 +49,13 @@ class Stat:
         self.thresholds = self.set_thresholds()
 
     def run(self):
+        start = time.perf_counter()
+        try:
+            return self.update()
+        finally:
+            registry.observe("maspeqc_stat_duration_seconds", time.perf_counter() - start, {"machine": self.machine})
+
+    def update(self):
     
         if not self.check_number_runs():
             logger.warning("5 runs or more needed for stats and normalised metrics")
@@ -107,18 +121,18 @@ class Stat:
 
     def compute_thermo_stats(self):
         sql_m = ""
-        sql_c = ""
+        comp_id = None
         if self.e_type == 'PROTEOMICS':
             sql_m = "SELECT metric_id FROM metric WHERE metric_type = 'thermo' AND use_prot = 'Y' " + \
                 " AND display_order > 0"
 
-            sql_c = "SELECT component_id FROM sample_component WHERE component_name = 'Hela Digest'"
+            comp_id = self.db.get_component_id('Hela Digest')
 
         elif self.e_type == 'METABOLOMICS':
             sql_m = "SELECT metric_id FROM metric WHERE metric_type = 'thermo' AND use_metab = 'Y' " + \
                   " AND display_order > 0"
 
-            sql_c = "SELECT component_id FROM sample_component WHERE component_name = 'Metab Digest'"
+            comp_id = self.db.get_component_id('Metab Digest')
 
         try:
             self.db.cursor.execute(sql_m)
@@ -126,12 +140,6 @@ class Stat:
         except Exception as e:
             logger.exception(e)
 
-        try:
-            self.db.cursor.execute(sql_c)
-            comp_id = self.db.cursor.fetchone()[0]
-        except Exception as e:
-            logger.exception(e)
-
         all_stats = []
         for metric in metrics:
             stats = []
@@ -287,30 +295,11 @@ class Stat:
 
     def insert_update_morpheus_stats(self):
 
-        sql_c = "SELECT component_id FROM sample_component WHERE component_name = 'Hela Digest'"
-
-        try:
-            self.db.cursor.execute(sql_c)
-            cid = self.db.cursor.fetchone()
-        except Exception as e:
-            logger.exception(e)
-
-        sql_mac = "SELECT machine_id FROM machine WHERE machine_name = '" + self.machine + "'"
-
-        try:
-            self.db.cursor.execute(sql_mac)
-            macid = self.db.cursor.fetchone()
-        except Exception as e:
-            logger.exception(e)
+        cid = self.db.get_component_id('Hela Digest')
+        macid = self.db.get_machine_id(self.machine)
 
         for i in range(len(self.hela_df)):
-            sql_m = "SELECT metric_id FROM metric WHERE metric_name = " + "'" + self.hela_df.iloc[i]['Metric'] + "'"
-
-            try:
-                self.db.cursor.execute(sql_m)
-                mid = self.db.cursor.fetchone()
-            except Exception as e:
-                logger.exception(e)
+            mid = self.db.get_metric_id(self.hela_df.iloc[i]['Metric'])
 
             mean = round(self.hela_df.iloc[i]['mean'], 8)
             std = round(self.hela_df.iloc[i]['std'], 8)
@@ -320,10 +309,10 @@ class Stat:
             med = round(self.hela_df.iloc[i]['50%'], 8)
             med75 = round(self.hela_df.iloc[i]['75%'], 8)
 
-            if not self.is_inserted_stat(mid[0], cid[0], macid[0]):
+            if not self.is_inserted_stat(mid, cid, macid):
 
-                sql = "INSERT into stat VALUES(" + "'" + str(mid[0]) + "','" + str(cid[0]) + "','" + \
-                             str(macid[0]) + "','" + str(self.hela_df.iloc[i]['count']) + "','" + str(mean) + \
+                sql = "INSERT into stat VALUES(" + "'" + str(mid) + "','" + str(cid) + "','" + \
+                             str(macid) + "','" + str(self.hela_df.iloc[i]['count']) + "','" + str(mean) + \
                              "','" + str(std) + "','" + str(dfMin) + "','" + \
                              str(med25) + "','" + str(med) + "','" + str(med75) + \
                              "','" + str(dfMax) + "')"
@@ -333,8 +322,8 @@ class Stat:
                         "', std = '" + str(std) + "', min = '" + str(dfMin) + \
                         "', 25_percent = '" + str(med25)  + "', 50_percent = '" + str(med)  + \
                         "', 75_percent = '" + str(med75) + "', max = '" + str(dfMax)  + \
-                        "' WHERE metric_id = '" + str(mid[0]) + "' AND component_id = '" + str(cid[0]) + \
-                        "' AND machine_id = '" + str(macid[0]) + "'"
+                        "' WHERE metric_id = '" + str(mid) + "' AND component_id = '" + str(cid) + \
+                        "' AND machine_id = '" + str(macid) + "'"
             try:
                 self.db.cursor.execute(sql)
             except Exception as e:
@@ -346,13 +335,7 @@ class Stat:
         # run after compute_stats()
         # columns = ['Component', 'Metric', 'Machine', 'count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
 
-        sql_mac = "SELECT machine_id FROM machine WHERE machine_name = '" + self.machine + "'"
-
-        try:
-            self.db.cursor.execute(sql_mac)
-            macid = self.db.cursor.fetchone()
-        except Exception as e:
-            logger.exception(e)
+        macid = self.db.get_machine_id(self.machine)
 
         for i in range(len(self.df)):
             mean = round(self.df.iloc[i]['mean'], 8)
@@ -363,10 +346,10 @@ class Stat:
             med = round(self.df.iloc[i]['50%'], 8)
             med75 = round(self.df.iloc[i]['75%'], 8)
 
-            if not self.is_inserted_stat(self.df.iloc[i]['Metric'], self.df.iloc[i]['Component'], macid[0]):
+            if not self.is_inserted_stat(self.df.iloc[i]['Metric'], self.df.iloc[i]['Component'], macid):
                 sql = "INSERT into stat VALUES(" + "'" + str(self.df.iloc[i]['Metric']) + "','" + \
                       str(self.df.iloc[i]['Component']) + "','" + \
-                             str(macid[0]) + "','" + str(self.df.iloc[i]['count']) + "','" + \
+                             str(macid) + "','" + str(self.df.iloc[i]['count']) + "','" + \
                       str(mean) + "','" + str(std) + "','" + str(dfMin) + "','" + \
                              str(med25) + "','" + str(med) + "','" + str(med75) + \
                              "','" + str(dfMax) + "')"
@@ -376,7 +359,7 @@ class Stat:
                         "', 25_percent = '" + str(med25)  + "', 50_percent = '" + str(med) + \
                         "', 75_percent = '" + str(med75) + "', max = '" + str(dfMax) + \
                         "' WHERE metric_id = '" + str(self.df.iloc[i]['Metric']) + "' AND component_id = '" + str(self.df.iloc[i]['Component']) + \
-                        "' AND machine_id = '" + str(macid[0]) + "'"
+                        "' AND machine_id = '" + str(macid) + "'"
             try:
                 self.db.cursor.execute(sql)
             except Exception as e:
@@ -454,18 +437,13 @@ class Stat:
                             norm_min = norm
 
                     # get metric id
-                    get_mid = "SELECT metric_id FROM metric WHERE metric_name = " + "'" + metric + "_normalised" + "'"
-                    try:
-                        self.db.cursor.execute(get_mid)
-                        mid = self.db.cursor.fetchone()
-                    except Exception as e:
-                        logger.exception(e)
+                    mid = self.db.get_metric_id(metric + "_normalised")
 
                     # deleting means all values are updated using current stats
-                    if self.is_inserted_measurement(mid[0], value[1], value[3]):
-                        self.delete_measurement(mid[0], value[1], value[3])
+                    if self.is_inserted_measurement(mid, value[1], value[3]):
+                        self.delete_measurement(mid, value[1], value[3])
 
-                    insert_med = "INSERT INTO measurement VALUES('" + str(mid[0]) + "',' " + \
+                    insert_med = "INSERT INTO measurement VALUES('" + str(mid) + "',' " + \
                                  str(value[1]) + "','" + str(value[3]) + "','" + str(round(norm,8)) + "')"
                     try:
                         self.db.cursor.execute(insert_med)
@@ -521,33 +499,21 @@ class Stat:
             logger.exception(e)
 
     def update_current_thresholds(self):
-        # read in current thresholds
-        with open(os.path.join(os.getcwd(), "Config", "thresholds", "thresholds-ms2-percentiles.json"), 'r') as f:
-            current_thresholds = json.load(f)
+        with thresholds_lock:
+            # read in current thresholds
+            with open(os.path.join(os.getcwd(), "Config", "thresholds", "thresholds-ms2-percentiles.json"), 'r') as f:
+                current_thresholds = json.load(f)
 
-        # update json
-        for i in range(len(self.hela_df)):
-            if self.hela_df.iloc[i]['Metric'] != 'Precursor Mass Error':
-                current_thresholds[self.machine][self.hela_df.iloc[i]['Metric']] = self.hela_df.iloc[i]['lower_thresh']
+            # update json
+            for i in range(len(self.hela_df)):
+                if self.hela_df.iloc[i]['Metric'] != 'Precursor Mass Error':
+                    current_thresholds[self.machine][self.hela_df.iloc[i]['Metric']] = self.hela_df.iloc[i]['lower_thresh']
 
-        # save json
-        with open(os.path.join(os.getcwd(), "Config", "thresholds", "thresholds-ms2-percentiles.json"), 'w') as f:
-            f.write(json.dumps(current_thresholds))
+            # save json
+            with open(os.path.join(os.getcwd(), "Config", "thresholds", "thresholds-ms2-percentiles.json"), 'w') as f:
+                f.write(json.dumps(current_thresholds))
 
     def set_thresholds(self):
         # get threshold limits
-        with open(self.fs.thresh_email) as f:
-            limits = f.readlines()
-
-        # remove header
-        limits.pop(0)
-
-        # create dict for storing
-        thresholds = {}
-        for limit in limits:
-            new_limit = limit.split("|")
-            if new_limit[1] != '':
-                thresholds[new_limit[0]] = [new_limit[1], new_limit[2], new_limit[3].strip()]
-
-        return thresholds
+        return read_thresholds(self.fs.thresh_email)
 
@@ -23,6 +23,8 @@ import math
 import glob
 import json
 import logging
+from MPMF_Config import config, read_pump_limits
+from MPMF_Metrics import registry
 logger = logging.getLogger('processing.thermo')
 
 try:
@@ -86,20 +88,21 @@ class ThermoMetrics:
                 self.mp_data = self.set_mp_data()
         else:
             logger.error('FileReader Error', self.rawfile.FileError)
+            registry.inc("maspeqc_thermo_errors_total", {"machine": self.machine})
 
         self.run()
         self.rawfile.Dispose()
+        registry.inc("maspeqc_thermo_files_total", {"machine": self.machine})
 
     def run(self):
         if self.exp.upper() == "PROTEOMICS":
             self.all_loading_pump()
             self.all_nano_pump()
             self.insert_co_temp()
-            self.insert_pressure_profile("np")
-            self.insert_pressure_profile("lp")
+            self.insert_pressure_profiles(["np", "lp"])
         else:
             self.all_main_pump()
-            self.insert_pressure_profile("mp")
+            self.insert_pressure_profiles(["mp"])
             
         logger.info("INSTRUMENT METRICS INSERTED FOR " + self.filename)
         logger.info("PROFILE DATA INSERTED FOR " + self.filename)
@@ -140,28 +143,14 @@ class ThermoMetrics:
         # may need to get these comp names from file for config purposes
 
         if self.exp == "METABOLOMICS":
-            sql = "SELECT component_id FROM sample_component WHERE component_name = 'Metab Digest'"
+            return self.db.get_component_id('Metab Digest')
         elif self.exp == "PROTEOMICS":
-            sql = "SELECT component_id FROM sample_component WHERE component_name = 'Hela Digest'"
-
-        try:
-            self.db.cursor.execute(sql)
-            return self.db.cursor.fetchone()[0]
-        except Exception as e:
-            logger.exception(e)
-            return False
+            return self.db.get_component_id('Hela Digest')
+        return False
             
     def get_valve_limits(self):
-        if os.path.exists(os.path.join(self.fs.config_dir, "pump", "loading-pump-" + self.machine + ".csv")):
-            with open(os.path.join(self.fs.config_dir, "pump", "loading-pump-" + self.machine + ".csv"), "r") as infile:
-                for line in infile:
-                    pump_limits = line.strip().split("|")
-            return pump_limits
-        else:
-            with open(os.path.join(self.fs.config_dir, "pump", "loading-pump.csv"), "r") as infile:
-                for line in infile:
-                    pump_limits = line.strip().split("|")
-            return pump_limits
+        return read_pump_limits(config.find(os.path.join(self.fs.config_dir, "pump", "loading-pump-" + self.machine + ".csv"),
+                                            os.path.join(self.fs.config_dir, "pump", "loading-pump.csv")))
             
     # LOADING PUMP - PROTEOMICS
     def create_lp_starting_bp(self):
@@ -553,16 +542,16 @@ class ThermoMetrics:
 
         
     # INSERT FUNCTIONS  
-    def insert_pressure_profile(self, pump):
+    def insert_pressure_profiles(self, pumps):
 
-        # get the profile data, convert to json and insert
-        data = self.create_data_bins(pump)
-        json_data = json.dumps(data, separators=(",", ":"))
-
-        sql = "INSERT INTO pressure_profile VALUES(NULL,'" + json_data + "','" + str(pump) + "','" + str(self.run_id) + "')"
+        # get the profile data of each pump, convert to json and insert together
+        rows = []
+        for pump in pumps:
+            data = self.create_data_bins(pump)
+            rows.append((json.dumps(data, separators=(",", ":")), str(pump), self.run_id))
 
         try:
-            self.db.cursor.execute(sql)
+            self.db.insert_rows("pressure_profile", rows)
         except Exception as e:
             logger.exception(e)
 
@@ -578,13 +567,7 @@ class ThermoMetrics:
     def insert_metrics(self, metrics):
         # INSERT (called by "all" functions)
         for metric in metrics:
-            sql = "SELECT metric_id FROM metric WHERE metric_name = '" + metric + "'"
-            try:
-                self.db.cursor.execute(sql)
-                metric_id = self.db.cursor.fetchone()[0]
-            except Exception as e:
-                logger.exception(e)
-
+            metric_id = self.db.get_metric_id(metric)
             insert_sql = "INSERT INTO measurement VALUES('" + str(metric_id) + "','" + \
                          str(self.comp_id) + "','" + str(self.run_id) + "','" + str(metrics[metric]) + "')"
 
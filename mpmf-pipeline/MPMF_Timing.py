@@ -0,0 +1,211 @@
+# MaSpeQC - Quality control software for LC-MS/MS instrumentation
+#
+# Copyright (C) 2018-2025  Simon Caven
+# Copyright (C) 2020-2025  Monash University
+# Copyright (C) 2022-2025  University of Applied Sciences Mittweida
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import contextlib
+import json
+import os
+import time
+import logging
+import MPMF_Database_SetUp
+from MPMF_Database_SetUp import MPMFDBSetUp
+from MPMF_Metrics import registry
+logger = logging.getLogger('processing.timing')
+
+# order of the stages in logs and reports
+STAGES = ["msconvert", "mzmine", "morpheus", "ingest", "thermo", "chromatogram"]
+
+# bytes read/written by the Python work of a stage can only be measured on Linux, elsewhere they are stored
+# as NULL rather than just the bytes of the tools
+THREAD_IO = os.path.exists("/proc/thread-self/io")
+
+
+def thread_io():
+    # (bytes read, bytes written) from storage by the calling thread, Linux only
+    read_bytes = 0
+    write_bytes = 0
+    try:
+        with open("/proc/thread-self/io", "r") as f:
+            for line in f:
+                key, value = line.split(":")
+                if key == "read_bytes":
+                    read_bytes = int(value)
+                elif key == "write_bytes":
+                    write_bytes = int(value)
+    except (OSError, ValueError):
+        pass
+    return read_bytes, write_bytes
+
+
+class StageTimer:
+    """
+        Wall time, CPU seconds, peak RSS of the tools and bytes read/written for the stages of a run
+        Python work is measured for the thread running the stage (stages can run in threads),
+        the tools through the resource usage recorded by the ToolRunner
+        Stored in the stage_timing table once the run is inserted
+        Used by ProcessRawFile and MPMF_Process_Raw_Files
+    """
+    def __init__(self, tools, machine):
+        self.tools = tools
+        self.machine = machine
+        self.stages = {}  # stage -> [wall, cpu, peak_rss, read_bytes, write_bytes]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = self.sample()
+        try:
+            yield
+        finally:
+            self.add(name, self.since(start))
+
+    def sample(self):
+        return time.perf_counter(), time.thread_time(), thread_io(), len(self.tools.invocations)
+
+    def since(self, start):
+        # usage since the sample
+        wall = time.perf_counter() - start[0]
+        cpu = time.thread_time() - start[1]
+        io = thread_io()
+        read_bytes = io[0] - start[2][0]
+        write_bytes = io[1] - start[2][1]
+        peak_rss = None
+        for invocation in self.tools.invocations[start[3]:]:
+            if invocation['usage'] is not None:
+                cpu += invocation['usage'][0]
+                peak_rss = max(peak_rss or 0, invocation['usage'][1])
+                read_bytes += invocation['usage'][2]
+                write_bytes += invocation['usage'][3]
+        return [wall, cpu, peak_rss, read_bytes, write_bytes]
+
+    def add(self, name, usage, share=1):
+        # adds the usage to the stage, share splits the usage of a batch between its runs
+        usage = [usage[0] / share, usage[1] / share, usage[2], usage[3] // share, usage[4] // share]
+        if name not in self.stages:
+            self.stages[name] = usage
+        else:
+            stage = self.stages[name]
+            stage[0] += usage[0]
+            stage[1] += usage[1]
+            if usage[2] is not None:
+                stage[2] = max(stage[2] or 0, usage[2])
+            stage[3] += usage[3]
+            stage[4] += usage[4]
+
+    def totals(self):
+        # (CPU seconds, bytes read and written) of all stages
+        cpu = sum(stage[1] for stage in self.stages.values())
+        io = sum(stage[3] + stage[4] for stage in self.stages.values())
+        return cpu, io
+
+    def summary(self):
+        names = sorted(self.stages, key=lambda x: STAGES.index(x) if x in STAGES else len(STAGES))
+        return ", ".join(name + " " + "{:.1f}".format(self.stages[name][0]) + "s" for name in names)
+
+    def save(self, db, file_name):
+        # inserts the stages for the qc_run of the file
+        if len(self.stages) == 0:
+            return
+        run_id = db.get_run_id(file_name)
+        if not run_id:
+            return
+
+        rows = []
+        for name in self.stages:
+            stage = self.stages[name]
+            if THREAD_IO:
+                rows.append((run_id, name, stage[0], stage[1], stage[2], stage[3], stage[4]))
+            else:
+                rows.append((run_id, name, stage[0], stage[1], stage[2], None, None))
+            registry.observe("maspeqc_stage_duration_seconds", stage[0], {"machine": self.machine, "stage": name})
+        try:
+            db.cursor.executemany("REPLACE INTO stage_timing (run_id, stage, wall_time, cpu_time, peak_rss, "
+                                  "read_bytes, write_bytes) VALUES (%s, %s, %s, %s, %s, %s, %s)", rows)
+            db.db.commit()
+        except Exception as e:
+            logger.exception(e)
+        logger.info("Stage times for " + file_name + ": " + self.summary())
+
+
+def report(db, experiment_type, days, machine=None):
+    # p50 and p95 per stage per machine for the runs processed in the last days
+    import numpy as np  # only needed for the report, not while processing
+    sql = "SELECT m.machine_name, t.stage, t.wall_time, t.cpu_time, t.peak_rss, t.read_bytes, t.write_bytes " \
+          "FROM stage_timing t JOIN qc_run q ON q.run_id = t.run_id " \
+          "JOIN machine m ON m.machine_id = q.machine_id " \
+          "JOIN experiment e ON e.experiment_id = q.experiment_id " \
+          "WHERE e.experiment_type = %s AND t.processed_at >= NOW() - INTERVAL %s DAY"
+    params = [experiment_type.lower(), days]
+    if machine:
+        sql += " AND m.machine_name = %s"
+        params.append(machine)
+    db.cursor.execute(sql, params)
+
+    timings = {}  # machine -> stage -> list of rows
+    for row in db.cursor.fetchall():
+        timings.setdefault(row[0], {}).setdefault(row[1], []).append(row[2:])
+
+    lines = []
+    header = "{:<20} {:<13} {:>5} {:>9} {:>9} {:>9} {:>9} {:>10} {:>9} {:>9}".format(
+        "machine", "stage", "runs", "wall p50", "wall p95", "cpu p50", "cpu p95", "rss p95MB", "read MB", "write MB")
+    lines.append(header)
+    for machine_name in sorted(timings):
+        stages = timings[machine_name]
+        for stage in sorted(stages, key=lambda x: STAGES.index(x) if x in STAGES else len(STAGES)):
+            rows = stages[stage]
+            wall = np.array([row[0] for row in rows], dtype=float)
+            cpu = np.array([row[1] for row in rows], dtype=float)
+            rss = [row[2] for row in rows if row[2] is not None]
+            # bytes are not measured on every platform (see THREAD_IO)
+            read_bytes = [row[3] for row in rows if row[3] is not None]
+            write_bytes = [row[4] for row in rows if row[4] is not None]
+            lines.append("{:<20} {:<13} {:>5} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>10} {:>9} {:>9}".format(
+                machine_name, stage, len(rows), np.percentile(wall, 50), np.percentile(wall, 95),
+                np.percentile(cpu, 50), np.percentile(cpu, 95),
+                "{:.0f}".format(np.percentile(rss, 95) / 1048576) if rss else "-",
+                "{:.1f}".format(np.mean(read_bytes) / 1048576) if read_bytes else "n/a",
+                "{:.1f}".format(np.mean(write_bytes) / 1048576) if write_bytes else "n/a"))
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    # Arguments: experiment (proteomics, metabolomics)
+    #            --days (optional, runs of the last days, default 30)
+    #            --machine (optional, one machine only)
+
+    parser = argparse.ArgumentParser(description="Processing time per stage (p50/p95) for each machine")
+    parser.add_argument("experiment", help="metabolomics or proteomics")
+    parser.add_argument("--days", type=int, default=30, help="runs processed in the last days")
+    parser.add_argument("--machine", help="report a single machine")
+    args = parser.parse_args()
+    MPMF_Database_SetUp.init_logging()
+
+    with open(os.path.join(os.getcwd(), "Config", "database-login.json"), "r") as f:
+        db_details = json.load(f)
+    with open(os.path.join(os.getcwd(), "Config", ".maspeqc_gen"), "r") as f:
+        password = f.read()
+
+    db = MPMFDBSetUp(db_details["User"], password, db_details["Database Name"], "", db_details["Database Port"],
+                     db_details.get("Database Host", "localhost"))
+    db.create_table_stage_timing()
+    print(report(db, args.experiment, args.days, args.machine))
+    print("mean MB read/written per run, cpu includes the tools")
+    db.cursor.close()
+    db.db.close()
@@ -0,0 +1,281 @@
+# MaSpeQC - Quality control software for LC-MS/MS instrumentation
+#
+# Copyright (C) 2018-2025  Simon Caven
+# Copyright (C) 2020-2025  Monash University
+# Copyright (C) 2022-2025  University of Applied Sciences Mittweida
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import ctypes
+import os
+import platform
+import signal
+import subprocess
+import threading
+import time
+import logging
+from MPMF_Metrics import registry
+logger = logging.getLogger('processing.tools')
+
+# lines of output kept for the error message of a failed tool
+TAIL_LINES = 20
+
+
+class IO_COUNTERS(ctypes.Structure):
+    _fields_ = [("ReadOperationCount", ctypes.c_ulonglong), ("WriteOperationCount", ctypes.c_ulonglong),
+                ("OtherOperationCount", ctypes.c_ulonglong), ("ReadTransferCount", ctypes.c_ulonglong),
+                ("WriteTransferCount", ctypes.c_ulonglong), ("OtherTransferCount", ctypes.c_ulonglong)]
+
+
+class JOBOBJECT_BASIC_AND_IO_ACCOUNTING_INFORMATION(ctypes.Structure):
+    _fields_ = [("TotalUserTime", ctypes.c_longlong), ("TotalKernelTime", ctypes.c_longlong),
+                ("ThisPeriodTotalUserTime", ctypes.c_longlong), ("ThisPeriodTotalKernelTime", ctypes.c_longlong),
+                ("TotalPageFaultCount", ctypes.c_ulong), ("TotalProcesses", ctypes.c_ulong),
+                ("ActiveProcesses", ctypes.c_ulong), ("TotalTerminatedProcesses", ctypes.c_ulong),
+                ("IoInfo", IO_COUNTERS)]
+
+
+class JOBOBJECT_EXTENDED_LIMIT_INFORMATION(ctypes.Structure):
+    _fields_ = [("PerProcessUserTimeLimit", ctypes.c_longlong), ("PerJobUserTimeLimit", ctypes.c_longlong),
+                ("LimitFlags", ctypes.c_ulong), ("MinimumWorkingSetSize", ctypes.c_size_t),
+                ("MaximumWorkingSetSize", ctypes.c_size_t), ("ActiveProcessLimit", ctypes.c_ulong),
+                ("Affinity", ctypes.c_size_t), ("PriorityClass", ctypes.c_ulong), ("SchedulingClass", ctypes.c_ulong),
+                ("IoInfo", IO_COUNTERS), ("ProcessMemoryLimit", ctypes.c_size_t), ("JobMemoryLimit", ctypes.c_size_t),
+                ("PeakProcessMemoryUsed", ctypes.c_size_t), ("PeakJobMemoryUsed", ctypes.c_size_t)]
+
+
+class ToolJob:
+    """
+        Windows job object holding a tool and the processes it starts
+        Gives the resource usage of the whole tree, which os.wait4 gives on Linux and macOS
+        Processes the shell starts before it is assigned to the job are not counted (the shell starts the tool
+        well after Popen returns)
+    """
+    BASIC_AND_IO_ACCOUNTING = 8  # JOBOBJECTINFOCLASS
+    EXTENDED_LIMIT = 9
+
+    def __init__(self, process):
+        self.kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        self.kernel32.CreateJobObjectW.restype = ctypes.c_void_p
+        self.kernel32.AssignProcessToJobObject.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        self.kernel32.QueryInformationJobObject.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                                            ctypes.c_ulong, ctypes.c_void_p]
+        self.kernel32.CloseHandle.argtypes = [ctypes.c_void_p]
+        self.handle = self.kernel32.CreateJobObjectW(None, None)
+        if not self.handle:
+            raise ctypes.WinError(ctypes.get_last_error())
+        if not self.kernel32.AssignProcessToJobObject(self.handle, int(process._handle)):
+            error = ctypes.get_last_error()
+            self.close()
+            raise ctypes.WinError(error)
+
+    def get_usage(self):
+        # (cpu seconds, peak memory bytes of a process, bytes read, bytes written)
+        accounting = JOBOBJECT_BASIC_AND_IO_ACCOUNTING_INFORMATION()
+        limits = JOBOBJECT_EXTENDED_LIMIT_INFORMATION()
+        for info_class, info in [(self.BASIC_AND_IO_ACCOUNTING, accounting), (self.EXTENDED_LIMIT, limits)]:
+            if not self.kernel32.QueryInformationJobObject(self.handle, info_class, ctypes.byref(info),
+                                                           ctypes.sizeof(info), None):
+                raise ctypes.WinError(ctypes.get_last_error())
+        # times in 100 nanosecond units
+        return ((accounting.TotalUserTime + accounting.TotalKernelTime) / 1e7, limits.PeakProcessMemoryUsed,
+                accounting.IoInfo.ReadTransferCount, accounting.IoInfo.WriteTransferCount)
+
+    def close(self):
+        if self.handle:
+            self.kernel32.CloseHandle(self.handle)
+            self.handle = None
+
+
+class ToolProcess:
+    """
+        A running external tool (msconvert, MZmine, Morpheus)
+        Output is read line by line into the log, the tool and anything it started
+        run in their own process group so they can be killed together
+    """
+    def __init__(self, tool, command, cwd, timeout):
+        self.tool = tool
+        self.command = command
+        self.timeout = timeout
+        self.returncode = None
+        self.duration = None
+        self.timed_out = False
+        self.usage = None  # (cpu seconds, peak rss bytes, bytes read, bytes written) of the tool
+        self.job = None  # Windows job object for the resource usage
+        self.tail = []
+        self.start = time.time()
+
+        if os.name == 'nt':
+            self.process = subprocess.Popen(command, shell=True, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                            stdin=subprocess.DEVNULL, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+            try:
+                self.job = ToolJob(self.process)
+            except OSError as e:
+                logger.warning(tool + ": no resource usage, " + str(e))
+        else:
+            self.process = subprocess.Popen(command, shell=True, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                            stdin=subprocess.DEVNULL, start_new_session=True)
+
+        self.reader = threading.Thread(target=self.read_output, name=tool + "-output", daemon=True)
+        self.reader.start()
+
+    def read_output(self):
+        for line in iter(self.process.stdout.readline, b''):
+            line = line.decode(errors='replace').rstrip()
+            if line:
+                logger.debug(self.tool + ": " + line)
+                self.tail.append(line)
+                if len(self.tail) > TAIL_LINES:
+                    self.tail.pop(0)
+        self.process.stdout.close()
+
+    def wait(self):
+        # returns the exit code, the tool is killed once it runs past its timeout
+        if self.returncode is not None:
+            return self.returncode
+
+        remaining = None
+        if self.timeout:
+            remaining = max(0, self.timeout - (time.time() - self.start))
+        if os.name == 'nt':
+            try:
+                self.process.wait(timeout=remaining)
+            except subprocess.TimeoutExpired:
+                self.timed_out = True
+                logger.error(self.tool + ": no result after " + str(self.timeout) + " seconds, killing")
+                self.kill()
+                self.process.wait()
+            if self.job is not None:
+                try:
+                    self.usage = self.job.get_usage()
+                except OSError as e:
+                    logger.warning(self.tool + ": no resource usage, " + str(e))
+                self.job.close()
+        else:
+            self.reap(remaining)
+
+        self.reader.join(5)
+        self.returncode = self.process.returncode
+        self.duration = time.time() - self.start
+
+        if self.returncode:
+            logger.error(self.tool + ": exit code " + str(self.returncode) + " after " + "{:.1f}".format(self.duration) + "s")
+            for line in self.tail:
+                logger.error(self.tool + ": " + line)
+        else:
+            logger.info(self.tool + ": finished in " + "{:.1f}".format(self.duration) + "s")
+
+        return self.returncode
+
+    def reap(self, timeout):
+        # waits with os.wait4 to get the resource usage of the tool and the processes it waited for
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        try:
+            while True:
+                pid, status, usage = os.wait4(self.process.pid, os.WNOHANG)
+                if pid:
+                    break
+                if deadline is not None and time.time() >= deadline:
+                    self.timed_out = True
+                    logger.error(self.tool + ": no result after " + str(self.timeout) + " seconds, killing")
+                    self.kill()
+                    pid, status, usage = os.wait4(self.process.pid, 0)
+                    break
+                time.sleep(0.05)
+        except ChildProcessError:
+            # already reaped by Popen.poll
+            self.process.wait()
+            return
+
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS, block I/O in 512 byte blocks
+        rss_unit = 1 if platform.system() == 'Darwin' else 1024
+        self.usage = (usage.ru_utime + usage.ru_stime, usage.ru_maxrss * rss_unit,
+                      usage.ru_inblock * 512, usage.ru_oublock * 512)
+
+    def get_usage(self):
+        # (cpu seconds, peak rss bytes, bytes read, bytes written), None when not available
+        return self.usage
+
+    def running(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        # kills the whole process tree (the shell, the tool and eg. the JVM it started)
+        if not self.running():
+            return
+        try:
+            if os.name == 'nt':
+                subprocess.call('taskkill /F /T /PID ' + str(self.process.pid), stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+            else:
+                os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError as e:
+            logger.warning(self.tool + ": unable to kill process " + str(e))
+
+
+class ToolRunner:
+    """
+        Runs the external tools with a wall clock timeout per tool,
+        output captured into the log and CPU/memory limits (not available on Windows)
+        Every invocation is recorded with its exit code and duration
+        Used by ProcessRawFile
+    """
+    def __init__(self, timeouts=None, memory_limit=0, cpu_limit=0):
+        self.timeouts = timeouts or {}  # tool -> seconds, 0 or missing for no timeout
+        self.memory_limit = memory_limit  # MB of address space, 0 for no limit
+        self.cpu_limit = cpu_limit  # CPU seconds, 0 for no limit
+        self.invocations = []  # [{'tool', 'command', 'returncode', 'duration', 'timed_out', 'usage'}]
+
+    def start(self, tool, command, cwd, timeout=None):
+        # starts the tool and returns the ToolProcess, call finish with it when done
+        # timeout overrides the timeout of the tool
+        logger.debug(tool + ": " + command)
+        if timeout is None:
+            timeout = self.timeouts.get(tool, 0)
+        return ToolProcess(tool, self.limits() + command, cwd, timeout)
+
+    def finish(self, process):
+        # waits for the tool, returns True if it succeeded
+        returncode = process.wait()
+        self.invocations.append({'tool': process.tool, 'command': process.command, 'returncode': returncode,
+                                 'duration': process.duration, 'timed_out': process.timed_out,
+                                 'usage': process.get_usage()})
+        registry.inc("maspeqc_tool_runs_total", {"tool": process.tool})
+        if returncode:
+            registry.inc("maspeqc_tool_failures_total",
+                         {"tool": process.tool, "reason": "timeout" if process.timed_out else "exit"})
+        return returncode == 0
+
+    def run(self, tool, command, cwd, timeout=None):
+        # runs the tool to the end, returns True if it succeeded
+        return self.finish(self.start(tool, command, cwd, timeout))
+
+    def limits(self):
+        # ulimit prefix for the shell command, the shell sets the limits before it starts the tool
+        # (no preexec_fn, which is not safe while other threads are running)
+        if os.name == 'nt' or (not self.memory_limit and not self.cpu_limit):
+            return ""
+
+        prefix = ""
+        if self.memory_limit:
+            prefix += "ulimit -v " + str(int(self.memory_limit) * 1024) + " && "  # kilobytes
+        if self.cpu_limit:
+            prefix += "ulimit -t " + str(int(self.cpu_limit)) + " && "
+        return prefix
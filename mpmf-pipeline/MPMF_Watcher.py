@@ -0,0 +1,122 @@
+# MaSpeQC - Quality control software for LC-MS/MS instrumentation
+#
+# Copyright (C) 2018-2025  Simon Caven
+# Copyright (C) 2020-2025  Monash University
+# Copyright (C) 2022-2025  University of Applied Sciences Mittweida
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import logging
+from MPMF_Catalog import file_signature
+logger = logging.getLogger('processing.watcher')
+
+try:
+    from inotify_simple import INotify, flags
+    inotify_lib = True
+except ImportError:
+    inotify_lib = False
+
+
+class RawFileWatcher:
+    """
+        Watches the machine folders of the input folder for new QC files
+        Uses inotify where available, otherwise (or for SMB mounts) polls the folders
+        A file is returned once it has been closed (inotify) or is unchanged
+        between two checks (polling and vendor folders eg. .d)
+        Used by MPMF_Process_Raw_Files in watch mode
+    """
+    def __init__(self, folders, prefix, file_formats, interval=10, poll=False):
+        self.folders = folders  # machine name -> folder
+        self.prefix = prefix
+        self.file_formats = file_formats
+        self.interval = interval
+        self.pending = {}  # path -> [machine, last signature]
+        self.known = set()
+        self.inotify = None
+        self.watches = {}
+
+        # files already there are left to the batch processing
+        for machine in self.folders:
+            for path in self.list_files(machine):
+                self.known.add(path)
+
+        if inotify_lib and not poll:
+            self.inotify = INotify()
+            for machine in self.folders:
+                if os.path.isdir(self.folders[machine]):
+                    wd = self.inotify.add_watch(self.folders[machine], flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+                    self.watches[wd] = machine
+            logger.info("Watching " + str(len(self.watches)) + " folders with inotify")
+        else:
+            logger.info("Polling " + str(len(self.folders)) + " folders every " + str(self.interval) + " seconds")
+
+    def wait(self, block=True):
+        # blocks for up to one interval, yields (machine, path, file_format) for the new QC files
+        # with block False only checks for files that are already there
+        if self.inotify:
+            for event in self.inotify.read(timeout=int(self.interval * 1000) if block else 0):
+                machine = self.watches.get(event.wd)
+                if machine is None or self.get_format(event.name) is None:
+                    continue
+                path = os.path.join(self.folders[machine], event.name)
+                if path in self.known:
+                    continue
+                if event.mask & flags.ISDIR or event.mask & flags.CREATE:
+                    # folders are written file by file, wait until they stop changing
+                    self.pending.setdefault(path, [machine, None])
+                else:
+                    self.pending.pop(path, None)
+                    self.known.add(path)
+                    yield machine, path, self.get_format(event.name)
+        else:
+            if block:
+                time.sleep(self.interval)
+            for machine in self.folders:
+                for path in self.list_files(machine):
+                    if path not in self.known:
+                        self.pending.setdefault(path, [machine, None])
+
+        for path in list(self.pending):
+            machine, last_signature = self.pending[path]
+            signature = file_signature(path)
+            if signature is None:
+                del self.pending[path]  # removed or renamed
+            elif signature == last_signature:
+                del self.pending[path]
+                self.known.add(path)
+                yield machine, path, self.get_format(os.path.basename(path))
+            else:
+                self.pending[path][1] = signature
+
+    def list_files(self, machine):
+        try:
+            with os.scandir(self.folders[machine]) as entries:
+                return [entry.path for entry in entries if self.get_format(entry.name) is not None]
+        except OSError:
+            return []
+
+    def get_format(self, name):
+        # returns the file format of a QC file name, None for other files
+        if not name.startswith(self.prefix):
+            return None
+        for file_format in self.file_formats:
+            if name.endswith(file_format):
+                return file_format
+        return None
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()